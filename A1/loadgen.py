@@ -0,0 +1,108 @@
+import argparse
+import math
+import random
+import socket
+import string
+import threading
+import time
+
+from client import SERVER_HOST, SERVER_PORT, recv_full, send_message
+
+def make_payload(rng, check_type, length):
+    """Build a payload of the given length; complex payloads are shuffled palindromes so their swaps get scored"""
+    alphabet = string.ascii_lowercase + string.digits
+    if check_type == "simple":
+        half = "".join(rng.choice(alphabet) for _ in range(length // 2))
+        middle = rng.choice(alphabet) if length % 2 else ""
+        text = half + middle + half[::-1]
+        if rng.random() < 0.5: # Roughly half of the simple checks should fail
+            text = rng.choice(alphabet) + text[1:] if len(text) > 1 else text
+        return text
+
+    half = [rng.choice(alphabet) for _ in range(length // 2)]
+    chars = half + half + ([rng.choice(alphabet)] if length % 2 else [])
+    rng.shuffle(chars)
+    return "".join(chars)
+
+def build_workload(seed, count, complex_ratio, lengths):
+    """Deterministic list of request messages for one connection"""
+    rng = random.Random(seed)
+    messages = []
+    for _ in range(count):
+        check_type = "complex" if rng.random() < complex_ratio else "simple"
+        messages.append(f"{check_type}|{make_payload(rng, check_type, rng.choice(lengths))}")
+    return messages
+
+def run_connection(host, port, messages, requests, deadline, latencies, errors):
+    """Replay messages on one connection, one outstanding request at a time, recording each round trip"""
+    try:
+        with socket.create_connection((host, port), timeout=30) as client_socket:
+            sent = 0
+            while sent < requests and time.perf_counter() < deadline:
+                message = messages[sent % len(messages)]
+                start = time.perf_counter()
+                if not send_message(client_socket, message) or recv_full(client_socket) is None:
+                    errors.append(message[:32])
+                    return
+                latencies.append(time.perf_counter() - start)
+                sent += 1
+    except OSError as e:
+        errors.append(str(e))
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+def run(host, port, connections, requests, duration, complex_ratio, lengths, distinct, seed):
+    """Drive the server with concurrent connections and return a summary of throughput and latency"""
+    workloads = [build_workload(seed + i, distinct, complex_ratio, lengths) for i in range(connections)]
+    latencies = [[] for _ in range(connections)] # one list per thread, so no locking is needed while running
+    errors = []
+
+    start = time.perf_counter()
+    deadline = start + duration if duration else float("inf")
+    threads = [threading.Thread(target=run_connection, args=(host, port, workloads[i], requests, deadline, latencies[i], errors))
+               for i in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    merged = sorted(latency for per_connection in latencies for latency in per_connection)
+    return {
+        "requests": len(merged),
+        "errors": len(errors),
+        "elapsed": elapsed,
+        "rps": len(merged) / elapsed if elapsed else 0.0,
+        "p50": percentile(merged, 0.50),
+        "p99": percentile(merged, 0.99),
+        "p999": percentile(merged, 0.999),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for the palindrome server")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("-c", "--connections", type=int, default=16, help="concurrent connections")
+    parser.add_argument("-n", "--requests", type=int, default=1000, help="requests per connection")
+    parser.add_argument("-d", "--duration", type=float, default=0, help="stop after this many seconds (0 = no limit)")
+    parser.add_argument("--complex-ratio", type=float, default=0.5, help="fraction of requests that are complex checks")
+    parser.add_argument("--lengths", default="16,256,4096", help="comma separated payload lengths to pick from")
+    parser.add_argument("--distinct", type=int, default=1000, help="distinct payloads per connection before repeating")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the payload mix, same seed = same run")
+    args = parser.parse_args()
+
+    lengths = [int(length) for length in args.lengths.split(",")]
+    summary = run(args.host, args.port, args.connections, args.requests, args.duration,
+                  args.complex_ratio, lengths, args.distinct, args.seed)
+
+    print(f"{summary['requests']} requests ({summary['errors']} errors) in {summary['elapsed']:.2f}s")
+    print(f"Throughput: {summary['rps']:.1f} requests/sec")
+    print(f"Latency p50: {summary['p50'] * 1000:.2f} ms, p99: {summary['p99'] * 1000:.2f} ms, "
+          f"p999: {summary['p999'] * 1000:.2f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -1,86 +1,399 @@
 import socket
 import threading
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import logging
-from collections import Counter 
+import logging.handlers
+import queue
+import random
+from collections import Counter, OrderedDict
 import errno
+import heapq
+import hashlib
+import codecs
+import json
+import bisect
+import selectors
+import sys
+import time
+
+try:
+    import numpy as np # Optional, lets batch checks run as array operations
+except ImportError:
+    np = None
 
 # Set up basic logging configuration
-logging.basicConfig(filename='server_log.txt', level=logging.INFO, format='%(asctime)s - %(message)s')
+LOG_FILE = 'server_log.txt'
+LOG_FORMAT = '%(asctime)s - %(message)s'
+logging.basicConfig(filename=LOG_FILE, level=logging.INFO, format=LOG_FORMAT)
 
 # Constants for the server configuration
 HOST = 'localhost'
 PORT = 6969
+SERVER_MODE = "threaded" # "threaded" starts a thread per connection, "selector" serves every connection from one event loop
+IDLE_TIMEOUT = 30 # Seconds a connection may sit idle before the server removes it
+RECV_SIZE = 4096 # Bytes read from a client socket per recv call
+POOL_WORKERS = os.cpu_count() or 1 # Worker processes for heavy complex checks, 0 keeps every check inline
+POOL_THRESHOLD = 20000 # Normalized length at which a complex check is shipped to the process pool
+# Workers start fresh instead of being forked from the server, so they never inherit its sockets or threads
+POOL_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+ASYNC_LOGGING = True # Hand log records to a background writer thread instead of writing them on the request path
+LOG_FLUSH_INTERVAL = 1.0 # Seconds the writer may hold written records before flushing them to disk
+LOG_BATCH_SIZE = 512 # Most records the writer takes off the queue per write
+LOG_PAYLOAD_LIMIT = 0 # Characters of each request/response payload that get logged, 0 logs them whole
+LOG_SAMPLE_RATE = 1.0 # Fraction of request/response lines that get logged
+
+# stream|simple|... and stream|complex|... payloads are checked as they arrive instead of being buffered
+STREAM_PREFIXES = {'simple': b'stream|simple|', 'complex': b'stream|complex|'}
+STREAM_HASH_BASE = 1 << 32 # One UTF-32 code unit per digit
+STREAM_HASH_MOD = (1 << 127) - 1 # Mersenne prime modulus for the rolling hashes
+
+CACHE_MAX_ENTRIES = 10000 # Most results the cache may hold, 0 turns caching off
+CACHE_MAX_BYTES = 8 * 1024 * 1024 # Most result bytes (digest + result) the cache may hold
+
+complex_pool = None # process pool for large complex checks, created when the server starts
+log_queue = None # records waiting for the background log writer
+log_thread = None
 
 activeThreads = [] # list of active threads for ease of management
 
-def recv_full(client_socket, delimiter ="\r\n"):
-    """Handles receiving errors and continues receiving until ending sequence is found""" 
+if np is not None: # Byte lookup tables used to normalize ASCII batches
+    ASCII_ALNUM = np.array([chr(b).isalnum() for b in range(128)] + [False] * 128)
+    ASCII_LOWER = np.array([ord(chr(b).lower()) if b < 128 else b for b in range(256)], dtype=np.uint8)
+
+# Results keyed by (check type, digest of the normalized input), oldest first; shared by every connection thread
+result_cache = OrderedDict()
+cache_lock = threading.Lock()
+cache_bytes = 0
+cache_hits = 0
+cache_misses = 0
+
+# Latency histograms (phases and check types) and traffic counters, reported through the stats| request
+REQUEST_TYPES = ('simple', 'complex', 'batch', 'stats', 'stream') # Request types that get their own latency histogram
+LATENCY_BUCKETS_MS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500] # upper bounds, last bucket is open
+stats_lock = threading.Lock()
+latency_stats = {} # name -> {"count", "total", "max", "buckets"}
+traffic_stats = {"active_connections": 0, "total_connections": 0, "bytes_in": 0, "bytes_out": 0}
+
+def recv_full(client_socket, conn, delimiter=b"\r\n"):
+    """Keep receiving into the connection's buffer until at least one full request is in it, then return all of them"""
     try:
-        buffer = ""
+        first_byte = None
         while True:
-            request_data = client_socket.recv(1024).decode()
+            request_data = client_socket.recv(RECV_SIZE)
             if not request_data:  # Client has closed the connection
                 return None
-            buffer += request_data # Add received data to the buffer
-            if delimiter in request_data: # Once delimiter is seen, we can stop receiving
-                break
+            if first_byte is None: # Time spent waiting for the client to start sending is not receive time
+                first_byte = time.perf_counter()
+            count_stat("bytes_in", len(request_data))
 
-        return buffer.split(delimiter)[0] # Remove delimiter and return it
+            requests = split_requests(conn, request_data, delimiter) # Add received data to the buffer
+            if requests: # Once a delimiter is seen, we can stop receiving
+                record_latency("receive", time.perf_counter() - first_byte)
+                return requests
     except socket.timeout:
         logging.error(f"Connection timed out on {HOST}:{PORT}") # Log timeout error if it occurs
 
+def split_requests(conn, data, delimiter=b"\r\n"):
+    """Add data to the connection's buffer and take out every complete request, leaving any partial one behind.
+
+    A stream| request is not buffered: its payload is fed to a running check as it arrives, and the finished
+    check is handed back in place of the request bytes."""
+    buffer = conn["inbuf"]
+    search_from = max(0, len(buffer) - len(delimiter) + 1) # A delimiter may straddle two reads
+    buffer += data
+    requests = []
+    while True:
+        if conn["stream"] is not None:
+            end = buffer.find(delimiter, search_from)
+            if end == -1:
+                # Everything except a possible partial delimiter goes into the running check
+                consumed = max(0, len(buffer) - len(delimiter) + 1)
+                feed_stream(conn["stream"], buffer[:consumed])
+                del buffer[:consumed]
+                return requests
+            feed_stream(conn["stream"], buffer[:end])
+            requests.append(conn["stream"])
+            conn["stream"] = None
+        else:
+            for check_type, prefix in STREAM_PREFIXES.items():
+                if buffer.startswith(prefix):
+                    conn["stream"] = start_stream(check_type)
+                    del buffer[:len(prefix)]
+                    break
+            if conn["stream"] is not None:
+                search_from = 0
+                continue
+
+            end = buffer.find(delimiter, search_from)
+            if end == -1:
+                return requests
+            requests.append(bytes(buffer[:end]))
+
+        del buffer[:end + len(delimiter)]
+        search_from = 0
+
+def answer_requests(requests, client_address):
+    """Answer a batch of pipelined requests in order, returning the replies and whether the connection should stay open"""
+    responses = []
+    for raw in requests:
+        if isinstance(raw, dict): # A stream| request whose payload has already been checked as it arrived
+            log_payload("Received request", f"stream|{raw['type']}|<{raw['length']} characters streamed>")
+            start = time.perf_counter()
+            responses.append(finish_stream(raw))
+            record_latency("stream", time.perf_counter() - start)
+            continue
+
+        try:
+            request_data = raw.decode()
+        except UnicodeDecodeError:
+            logging.error(f"Decode error: Received bytes from {client_address} that are not valid UTF-8")
+            return responses, False
+        if not request_data: # An empty request ends the session
+            return responses, False
+
+        log_payload("Received request", request_data)
+
+        # Here, the request is processed to determine the response
+        start = time.perf_counter()
+        responses.append(process_request(request_data))
+        request_type = request_data.split('|', 1)[0]
+        # Clients choose the type, so anything unknown shares one histogram instead of growing the stats without limit
+        record_latency(request_type if request_type in REQUEST_TYPES else "invalid", time.perf_counter() - start)
+
+    return responses, True
+
 def handle_client(client_socket, client_address):
     """ Handle incoming client requests. """
     logging.info(f"Connection from {client_address}")
+    conn = {"inbuf": bytearray(), "stream": None} # Bytes that do not form a full request yet, and any stream in progress
+    count_stat("active_connections")
+    count_stat("total_connections")
     
     try:
         while True:
-            # Receive data from the client
-            request_data = recv_full(client_socket)
-            if not request_data:  # Client has closed the connection
+            # Receive every request the client has pipelined so far
+            requests = recv_full(client_socket, conn)
+            if not requests:  # Client has closed the connection
                 break
 
-            logging.info(f"Received request: {request_data}")
-            
-            # Here, the request is processed to determine the response
-            response = process_request(request_data)
-            try:
-                client_socket.sendall(response.encode())
-            except UnicodeEncodeError:
-                logging.error(f"Encode error: Unable to encode the string '{response}' into UTF-8")
-                break # if there was an issue sending, close the connection
-            except Exception as e:
-                logging.error(f"Send error: {e}")
-                break # if there was an issue sending, close the connection
-
-            logging.info(f"Sent response: {response}")
+            responses, keep_open = answer_requests(requests, client_address)
+            if responses:
+                response = "".join(responses) # One send for the whole batch of replies
+                try:
+                    start = time.perf_counter()
+                    response_bytes = response.encode()
+                    client_socket.sendall(response_bytes)
+                    record_latency("send", time.perf_counter() - start)
+                    count_stat("bytes_out", len(response_bytes))
+                except UnicodeEncodeError:
+                    logging.error(f"Encode error: Unable to encode the string '{response}' into UTF-8")
+                    break # if there was an issue sending, close the connection
+                except Exception as e:
+                    logging.error(f"Send error: {e}")
+                    break # if there was an issue sending, close the connection
+
+                for response in responses:
+                    log_payload("Sent response", response)
+
+            if not keep_open:
+                break
     except ConnectionResetError:
         logging.error(f"Connection reset by {HOST}")
     finally:
         # Close the client connection
-        client_socket.shutdown(socket.SHUT_RDWR)
+        try:
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass # The peer may already be gone
         client_socket.close()
+        count_stat("active_connections", -1)
         logging.info(f"Closed connection with {client_address}")
 
 def process_request(request_data):
     """ Process the client's request and generate a response. """
     try:
+        if request_data.startswith('batch|'): # batch|<check type>|<string>|<string>...
+            return process_batch(request_data)
+        if request_data.startswith('stats|'):
+            return f"Stats: {json.dumps(stats_snapshot())}\r\n"
+
         # Students need to parse the request and call the appropriate palindrome function
         check_type, input_string = request_data.split('|')
-        input_string = ''.join(e for e in input_string if e.isalnum()).lower()
-        
-        if check_type == 'simple':
-            result = is_palindrome(input_string)
-            return f"Is palindrome: {result}\r\n"
-        elif check_type == 'complex':
-            is_complex, swaps = complex_palindrome(input_string)
-            return f"Can form a palindrome: {is_complex}\nComplexity score: {swaps} (number of swaps)\r\n"
-        else: # There is some sort of error with the received request
+        input_string = normalize(input_string)
+
+        if check_type not in ('simple', 'complex'): # There is some sort of error with the received request
             logging.info(f"Invalid client request type: {check_type}")
+            return ""
+
+        if check_type == 'simple':
+            return f"Is palindrome: {cached_check(check_type, input_string)}\r\n"
+        is_complex, swaps = cached_check(check_type, input_string)
+        return f"Can form a palindrome: {is_complex}\nComplexity score: {swaps} (number of swaps)\r\n"
     except Exception as e:
         return f"Received possibly malformed data: {e}"
 
-    return ""
+def cached_check(check_type, input_string):
+    """ Result of a check on a normalized string, answered from the cache when the same input was seen before. """
+    key = (check_type, hashlib.blake2b(input_string.encode(), digest_size=16).digest())
+    result = cache_get(key)
+    if result is None:
+        result = is_palindrome(input_string) if check_type == 'simple' else score_complex(input_string)
+        cache_put(key, result)
+    return result
+
+def process_batch(request_data):
+    """ Answer a batch request with one result per string, all on a single line. """
+    _, check_type, *strings = request_data.split('|')
+    if check_type not in ('simple', 'complex'):
+        logging.info(f"Invalid client request type: {check_type}")
+        return ""
+
+    results = batch_check(strings, check_type)
+    if check_type == 'simple':
+        return f"Batch results: {' '.join(str(result) for result in results)}\r\n"
+    return f"Batch results: {' '.join(f'{is_complex}:{swaps}' for is_complex, swaps in results)}\r\n"
+
+def normalize(input_string):
+    """ Keep only the alphanumeric characters, lowercased. """
+    return ''.join(e for e in input_string if e.isalnum()).lower()
+
+def batch_check(strings, check_type='simple'):
+    """ Check many strings at once: a list of bools for simple checks, or of (bool, swaps) for complex ones. """
+    strings = list(strings)
+    results = [None] * len(strings)
+
+    # ASCII strings can be normalized and compared as one flat byte array, anything else goes one by one
+    if np is not None:
+        ascii_idx = [i for i, string in enumerate(strings) if string.isascii()]
+    else:
+        ascii_idx = []
+    if ascii_idx:
+        for i, result in zip(ascii_idx, batch_check_arrays([strings[i] for i in ascii_idx], check_type)):
+            results[i] = result
+
+    for i, string in enumerate(strings):
+        if results[i] is None:
+            string = normalize(string)
+            results[i] = is_palindrome(string) if check_type == 'simple' else cached_check(check_type, string)
+
+    return results
+
+def batch_check_arrays(strings, check_type):
+    """ NumPy version of batch_check for ASCII strings. """
+    encoded = [string.encode('ascii') for string in strings]
+    raw = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    owner = np.repeat(np.arange(len(encoded)), [len(e) for e in encoded]) # which string each byte belongs to
+
+    # Normalize every string at once: drop non-alphanumerics, then lowercase through a lookup table
+    keep = ASCII_ALNUM[raw]
+    chars = ASCII_LOWER[raw[keep]]
+    owner = owner[keep]
+    lengths = np.bincount(owner, minlength=len(encoded))
+    starts = np.cumsum(lengths) - lengths
+
+    if check_type == 'simple':
+        # Compare every character with its mirror inside the same string
+        mirror = 2 * starts[owner] + lengths[owner] - 1 - np.arange(len(chars))
+        mismatches = np.bincount(owner[chars != chars[mirror]], minlength=len(encoded))
+        return (mismatches == 0).tolist()
+
+    # Count (string, character) pairs, then how many characters occur an odd number of times in each string
+    pairs, counts = np.unique(owner * 256 + chars.astype(np.int64), return_counts=True)
+    odd = np.bincount(pairs[counts % 2 == 1] // 256, minlength=len(encoded))
+
+    results = []
+    for i in range(len(encoded)):
+        if odd[i] > 1:
+            results.append((False, 0))
+        else: # Only strings that can form a palindrome need their swaps scored, large ones on the process pool
+            string = chars[starts[i]:starts[i] + lengths[i]].tobytes().decode('ascii')
+            results.append(cached_check(check_type, string))
+    return results
+
+def start_stream(check_type):
+    """ Running state for a stream| check, which never holds more than the current chunk of its payload. """
+    return {"type": check_type, "decoder": codecs.getincrementaldecoder('utf-8')(), "error": None, "length": 0,
+            "forward": 0, "reverse": 0, "power": 1, "odd": set()}
+
+def feed_stream(stream, data, final=False):
+    """ Normalize the next chunk of a streamed payload and fold it into the running hashes or parity counts. """
+    if stream["error"] is not None:
+        return
+    try:
+        text = normalize(stream["decoder"].decode(bytes(data), final))
+    except UnicodeDecodeError as e:
+        stream["error"] = e # Reported once the request ends
+        return
+    if not text:
+        return
+
+    if stream["type"] == 'simple':
+        # Polynomial hashes in base 2^32: the big-endian UTF-32 bytes read forwards, the little-endian ones read the
+        # chunk backwards, so int.from_bytes hashes a whole chunk in C instead of a loop per character
+        shift = pow(STREAM_HASH_BASE, len(text), STREAM_HASH_MOD)
+        forward = int.from_bytes(text.encode('utf-32-be'), 'big') % STREAM_HASH_MOD
+        reverse = int.from_bytes(text.encode('utf-32-le'), 'little') % STREAM_HASH_MOD
+        stream["forward"] = (stream["forward"] * shift + forward) % STREAM_HASH_MOD
+        stream["reverse"] = (stream["reverse"] + reverse * stream["power"]) % STREAM_HASH_MOD
+        stream["power"] = stream["power"] * shift % STREAM_HASH_MOD
+    else:
+        # Only which characters occur an odd number of times matters for feasibility
+        stream["odd"].symmetric_difference_update(c for c, count in Counter(text).items() if count % 2)
+    stream["length"] += len(text)
+
+def finish_stream(stream):
+    """ Produce the response for a stream| check once its delimiter has arrived. """
+    feed_stream(stream, b"", final=True)
+    if stream["error"] is not None:
+        return f"Received possibly malformed data: {stream['error']}\r\n"
+    if stream["type"] == 'simple':
+        return f"Is palindrome: {stream['forward'] == stream['reverse']}\r\n"
+    return f"Can form a palindrome: {len(stream['odd']) <= 1}\r\n" # Swaps need the whole string, so none are scored
+
+def cache_get(key):
+    """ Return the cached result for key (marking it most recently used), or None on a miss. """
+    global cache_hits, cache_misses
+
+    with cache_lock:
+        result = result_cache.get(key)
+        if result is None:
+            cache_misses += 1
+            return None
+        result_cache.move_to_end(key)
+        cache_hits += 1
+        return result
+
+def cache_entry_size(key, result):
+    """ Bytes an entry is counted as: its check type, digest and result. """
+    return len(key[0]) + len(key[1]) + len(repr(result))
+
+def cache_put(key, result):
+    """ Store a result, evicting least recently used entries until the cache is back within its limits. """
+    global cache_bytes
+
+    size = cache_entry_size(key, result)
+    if CACHE_MAX_ENTRIES <= 0 or size > CACHE_MAX_BYTES:
+        return
+
+    with cache_lock:
+        previous = result_cache.pop(key, None)
+        if previous is not None:
+            cache_bytes -= cache_entry_size(key, previous)
+        result_cache[key] = result
+        cache_bytes += size
+
+        while len(result_cache) > CACHE_MAX_ENTRIES or cache_bytes > CACHE_MAX_BYTES:
+            old_key, old_result = result_cache.popitem(last=False)
+            cache_bytes -= cache_entry_size(old_key, old_result)
+
+def cache_stats():
+    """ Snapshot of the result cache counters. """
+    with cache_lock:
+        return {"hits": cache_hits, "misses": cache_misses, "entries": len(result_cache), "bytes": cache_bytes}
 
 def is_palindrome(input_string):
     """ Check if the given string is a palindrome. """
@@ -140,28 +453,92 @@ def complex_palindrome(input_string):
 
     return (True, swaps)
 
+def fast_complex_palindrome(input_string):
+    """Same swap score as complex_palindrome, but indexes character positions so each mirror lookup is O(log n)"""
+    occurences = Counter(input_string)
+    oddChars = [c for c in occurences if occurences[c] % 2 != 0]
+    if len(oddChars) > 1: # More than one odd occuring character means no palindrome can be formed
+        return (False, 0)
+
+    swaps = 0
+    input_list = list(input_string)
+    left, right = 0, len(input_list) - 1
+
+    # Same odd character pre-swap as complex_palindrome: the first occurence is moved to the middle
+    if len(input_list) % 2 != 0:
+        midIdx = len(input_list) // 2
+        i = input_list.index(oddChars[0])
+        if i != midIdx:
+            input_list[midIdx], input_list[i] = input_list[i], input_list[midIdx]
+            swaps += 1
+
+    # Min-heap of positions for every character, stale entries are discarded lazily when they reach the top
+    positions = {}
+    for i, c in enumerate(input_list):
+        positions.setdefault(c, []).append(i) # enumerate order means every list is already a valid heap
+
+    while left < right:
+        target = input_list[right]
+        if input_list[left] != target:
+            # The first match after left is the smallest live position of the target character
+            heap = positions[target]
+            while heap[0] <= left or input_list[heap[0]] != target:
+                heapq.heappop(heap)
+            i = heap[0]
+            if i < right: # right itself is always live, so anything smaller is the mirror we were searching for
+                heapq.heappop(heap)
+                input_list[i], input_list[left] = input_list[left], input_list[i]
+                heapq.heappush(positions[input_list[i]], i) # the displaced character now lives at i
+                swaps += 1
+
+        left += 1 # Update the pointers until we get to the middle of the list
+        right -= 1
+
+    return (True, swaps)
+
+def score_complex(input_string):
+    """ Run the complex check inline, or on the process pool when the input is big enough to be worth shipping. """
+    if complex_pool is not None and len(input_string) >= POOL_THRESHOLD:
+        try:
+            # The calling thread just waits here, so the GIL is free for other connections meanwhile
+            return complex_pool.submit(fast_complex_palindrome, input_string).result()
+        except BrokenProcessPool:
+            logging.error("Process pool is broken, running complex check inline")
+    return fast_complex_palindrome(input_string)
+
+def start_complex_pool():
+    """ Start the worker processes used for large complex checks. """
+    global complex_pool
+
+    if POOL_WORKERS > 0:
+        complex_pool = ProcessPoolExecutor(max_workers=POOL_WORKERS, mp_context=multiprocessing.get_context(POOL_START_METHOD))
+        logging.info(f"Started {POOL_WORKERS} worker processes for complex checks of {POOL_THRESHOLD}+ characters")
+
+def stop_complex_pool():
+    """ Shut down the worker processes, if any were started. """
+    global complex_pool
+
+    if complex_pool is not None:
+        complex_pool.shutdown(wait=True, cancel_futures=True)
+        complex_pool = None
+        logging.info("Complex check worker processes have been shut down")
+
 def start_server():
     """ Start the server and listen for incoming connections. """
-    global activeThreads
-
     try:
+        if ASYNC_LOGGING:
+            start_async_logging()
+        start_complex_pool()
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
             server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # to allow ports to be reused immediately
             server_socket.bind((HOST, PORT)) # Bind this program to this IP and PORT
             server_socket.listen(5) # Allow 5 devices to be in the backlog
-            logging.info(f"Server started and listening on {HOST}:{PORT}")
-            
-            while True:
-                # Accept new client connections and start a thread for each client
-                client_socket, client_address = server_socket.accept()
-                client_socket.settimeout(30) # To prevent hanging, connection with client should be removed after 30 secs
-                thread = threading.Thread(target=handle_client, args=(client_socket, client_address))
-                thread.daemon = True 
-                thread.start()
-
-                activeThreads.append(thread) # Add new thread to list of active threads
-                # Filter list of active threads according to whether they are still alive
-                activeThreads = list(filter(lambda t: t.is_alive(), activeThreads)) 
+            logging.info(f"Server started and listening on {HOST}:{PORT} ({SERVER_MODE} mode)")
+
+            if SERVER_MODE == "selector":
+                serve_selector(server_socket)
+            else:
+                serve_threaded(server_socket)
     except socket.gaierror as e:
         logging.error(f"Address resolution error: {e.strerror}")
     except ConnectionRefusedError:
@@ -180,6 +557,246 @@ def start_server():
         shutdownServer()
     except Exception as e:
         logging.error(f"Unexpected error encountered: {e}")
+    finally:
+        stop_complex_pool()
+        stop_async_logging()
+
+def serve_threaded(server_socket):
+    """ Accept connections forever, handing each one to its own thread. """
+    global activeThreads
+
+    while True:
+        # Accept new client connections and start a thread for each client
+        client_socket, client_address = server_socket.accept()
+        client_socket.settimeout(IDLE_TIMEOUT) # To prevent hanging, connection with client should be removed after 30 secs
+        thread = threading.Thread(target=handle_client, args=(client_socket, client_address))
+        thread.daemon = True 
+        thread.start()
+
+        activeThreads.append(thread) # Add new thread to list of active threads
+        # Filter list of active threads according to whether they are still alive
+        activeThreads = list(filter(lambda t: t.is_alive(), activeThreads)) 
+
+def serve_selector(server_socket, delimiter=b"\r\n"):
+    """ Serve every client from a single selector loop, each connection keeping its own buffers. """
+    server_socket.setblocking(False)
+    selector = selectors.DefaultSelector()
+    selector.register(server_socket, selectors.EVENT_READ, data=None) # data=None marks the listening socket
+
+    last_sweep = time.monotonic()
+    try:
+        while True:
+            for key, events in selector.select(timeout=1):
+                if key.data is None:
+                    accept_connection(selector, key.fileobj)
+                else:
+                    service_connection(selector, key.fileobj, key.data, events, delimiter)
+
+            # Mirror the threaded mode's socket timeout by dropping connections that have gone quiet.
+            # Scanning every connection is O(n), so it happens about once a second rather than after every wakeup
+            now = time.monotonic()
+            if now - last_sweep >= 1:
+                last_sweep = now
+                for key in list(selector.get_map().values()):
+                    if key.data is not None and now - key.data["last_active"] > IDLE_TIMEOUT:
+                        logging.error(f"Connection timed out on {HOST}:{PORT}")
+                        close_connection(selector, key.fileobj, key.data)
+    finally:
+        for key in list(selector.get_map().values()):
+            if key.data is not None:
+                close_connection(selector, key.fileobj, key.data)
+        selector.close()
+
+def accept_connection(selector, server_socket):
+    """ Accept a pending client and register it with the selector. """
+    try:
+        client_socket, client_address = server_socket.accept()
+    except BlockingIOError:
+        return # Another wakeup already took this connection
+
+    client_socket.setblocking(False)
+    conn = {"address": client_address, "inbuf": bytearray(), "outbuf": bytearray(), "closing": False,
+            "last_active": time.monotonic(), "first_byte": None, "stream": None}
+    selector.register(client_socket, selectors.EVENT_READ, data=conn)
+    count_stat("active_connections")
+    count_stat("total_connections")
+    logging.info(f"Connection from {client_address}")
+
+def service_connection(selector, client_socket, conn, events, delimiter):
+    """ Read whatever the client sent, answer every complete request and flush pending responses. """
+    if events & selectors.EVENT_READ and not conn["closing"]:
+        try:
+            data = client_socket.recv(RECV_SIZE)
+        except BlockingIOError:
+            data = None
+        except ConnectionResetError:
+            logging.error(f"Connection reset by {HOST}")
+            close_connection(selector, client_socket, conn)
+            return
+
+        if data is not None:
+            if not data: # Client has closed the connection
+                close_connection(selector, client_socket, conn)
+                return
+            conn["last_active"] = time.monotonic()
+            count_stat("bytes_in", len(data))
+            if conn["first_byte"] is None:
+                conn["first_byte"] = time.perf_counter()
+
+            # Answer every complete request sitting in the buffer, leaving any partial one for the next read
+            requests = split_requests(conn, data, delimiter)
+            if requests:
+                now = time.perf_counter()
+                record_latency("receive", now - conn["first_byte"])
+                conn["first_byte"] = now if conn["inbuf"] else None # A leftover partial request started arriving just now
+                responses, keep_open = answer_requests(requests, conn["address"])
+                response = "".join(responses)
+                try:
+                    conn["outbuf"] += response.encode()
+                except UnicodeEncodeError:
+                    logging.error(f"Encode error: Unable to encode the string '{response}' into UTF-8")
+                    close_connection(selector, client_socket, conn)
+                    return
+                for response in responses:
+                    log_payload("Sent response", response)
+                conn["closing"] = not keep_open # Flush what was answered, then hang up
+
+    if conn["outbuf"]:
+        try:
+            start = time.perf_counter()
+            sent = client_socket.send(conn["outbuf"])
+            record_latency("send", time.perf_counter() - start)
+            count_stat("bytes_out", sent)
+            del conn["outbuf"][:sent]
+        except BlockingIOError:
+            pass
+        except Exception as e:
+            logging.error(f"Send error: {e}")
+            close_connection(selector, client_socket, conn)
+            return
+
+    if conn["closing"] and not conn["outbuf"]:
+        close_connection(selector, client_socket, conn)
+        return
+
+    # Only ask for write readiness while there is something left to send
+    wanted = (0 if conn["closing"] else selectors.EVENT_READ) | (selectors.EVENT_WRITE if conn["outbuf"] else 0)
+    if selector.get_key(client_socket).events != wanted:
+        selector.modify(client_socket, wanted, data=conn)
+
+def close_connection(selector, client_socket, conn):
+    """ Unregister and close a selector-managed client connection. """
+    selector.unregister(client_socket)
+    try:
+        client_socket.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass # The peer may already be gone
+    client_socket.close()
+    count_stat("active_connections", -1)
+    logging.info(f"Closed connection with {conn['address']}")
+
+def record_latency(name, seconds):
+    """ Add one timing to the histogram for a phase or check type. """
+    milliseconds = seconds * 1000
+    with stats_lock:
+        histogram = latency_stats.get(name)
+        if histogram is None:
+            histogram = latency_stats[name] = {"count": 0, "total": 0.0, "max": 0.0, "buckets": [0] * (len(LATENCY_BUCKETS_MS) + 1)}
+        histogram["count"] += 1
+        histogram["total"] += milliseconds
+        histogram["max"] = max(histogram["max"], milliseconds)
+        histogram["buckets"][bisect.bisect_left(LATENCY_BUCKETS_MS, milliseconds)] += 1
+
+def count_stat(name, amount=1):
+    """ Bump one of the traffic counters. """
+    with stats_lock:
+        traffic_stats[name] += amount
+
+def stats_snapshot():
+    """ Copy of every counter and histogram, in a form that can be sent back to a client. """
+    with stats_lock:
+        latencies = {}
+        for name, histogram in latency_stats.items():
+            latencies[name] = {
+                "count": histogram["count"],
+                "avg_ms": round(histogram["total"] / histogram["count"], 3),
+                "max_ms": round(histogram["max"], 3),
+                "buckets": list(histogram["buckets"]),
+            }
+        snapshot = dict(traffic_stats, latency_ms=latencies, bucket_bounds_ms=LATENCY_BUCKETS_MS)
+    snapshot["cache"] = cache_stats()
+    return snapshot
+
+def log_payload(prefix, payload):
+    """ Log a request or response line, subject to sampling and payload truncation. """
+    if LOG_SAMPLE_RATE < 1.0 and random.random() >= LOG_SAMPLE_RATE:
+        return
+    if LOG_PAYLOAD_LIMIT and len(payload) > LOG_PAYLOAD_LIMIT:
+        payload = f"{payload[:LOG_PAYLOAD_LIMIT]}... ({len(payload)} characters)"
+    logging.info(f"{prefix}: {payload}")
+
+def start_async_logging():
+    """ Route every log record through a queue so that only the writer thread touches the log file. """
+    global log_queue, log_thread
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]: # Drop the synchronous file handler set up by basicConfig
+        root.removeHandler(handler)
+        handler.close()
+
+    log_queue = queue.SimpleQueue()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    log_thread = threading.Thread(target=log_writer, args=(log_queue,), daemon=True)
+    log_thread.start()
+
+def log_writer(records):
+    """ Drain queued records into the log file in batches, flushing at most every LOG_FLUSH_INTERVAL seconds. """
+    formatter = logging.Formatter(LOG_FORMAT)
+    with open(LOG_FILE, 'a', encoding='utf-8') as log_file:
+        last_flush = time.monotonic()
+        unflushed = False
+        while True:
+            timeout = max(0, LOG_FLUSH_INTERVAL - (time.monotonic() - last_flush)) if unflushed else None
+            try:
+                batch = [records.get(timeout=timeout)]
+            except queue.Empty: # Quiet period, push out what has been written so far
+                log_file.flush()
+                last_flush, unflushed = time.monotonic(), False
+                continue
+
+            while len(batch) < LOG_BATCH_SIZE:
+                try:
+                    batch.append(records.get_nowait())
+                except queue.Empty:
+                    break
+
+            stopping = None in batch # Sentinel queued by stop_async_logging
+            log_file.write(''.join(formatter.format(record) + '\n' for record in batch if record is not None))
+            unflushed = True
+
+            if stopping or time.monotonic() - last_flush >= LOG_FLUSH_INTERVAL:
+                log_file.flush()
+                last_flush, unflushed = time.monotonic(), False
+            if stopping:
+                return
+
+def stop_async_logging():
+    """ Flush everything still queued and return to writing the log file directly. """
+    global log_queue, log_thread
+
+    if log_thread is None:
+        return
+
+    log_queue.put(None)
+    log_thread.join()
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    file_handler = logging.FileHandler(LOG_FILE)
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    root.addHandler(file_handler)
+    log_queue = log_thread = None
 
 def shutdownServer():
     logging.info(f"Beginning shutdown process for {HOST}:{PORT}...")
@@ -187,7 +804,10 @@ def shutdownServer():
     for thread in activeThreads:
         thread.join() # Join back to the main process
 
+    logging.info(f"Result cache at shutdown: {cache_stats()}")
     logging.info(f"Shutdown process for {HOST}:{PORT} has been completed cleanly.")
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1: # Optionally pick the serving mode from the command line, e.g. `python server.py selector`
+        SERVER_MODE = sys.argv[1]
     start_server()
@@ -0,0 +1,32 @@
+import random
+import unittest
+
+from server import complex_palindrome, fast_complex_palindrome
+
+class FastComplexPalindromeTest(unittest.TestCase):
+    """fast_complex_palindrome must give the same answer and swap count as complex_palindrome"""
+
+    def check(self, text):
+        self.assertEqual(fast_complex_palindrome(text), complex_palindrome(text), repr(text))
+
+    def test_edge_cases(self):
+        for text in ["", "a", "aa", "ab", "aab", "aba", "abba", "abab", "aabb", "baab", "aaabbbb", "mamad", "asflkj"]:
+            self.check(text)
+
+    def test_random_rearranged_palindromes(self):
+        rng = random.Random(1)
+        for _ in range(3000):
+            alphabet = "abcdefghij"[:rng.randint(1, 10)]
+            half = [rng.choice(alphabet) for _ in range(rng.randint(0, 40))]
+            chars = half + half + ([rng.choice(alphabet)] if rng.random() < 0.5 else [])
+            rng.shuffle(chars)
+            self.check("".join(chars))
+
+    def test_random_strings(self):
+        rng = random.Random(2)
+        for _ in range(3000):
+            alphabet = "abc12"[:rng.randint(1, 5)]
+            self.check("".join(rng.choice(alphabet) for _ in range(rng.randint(0, 30))))
+
+if __name__ == "__main__":
+    unittest.main()
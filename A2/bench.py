@@ -0,0 +1,258 @@
+import argparse
+import http.server
+import math
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    import resource # Unix only, used for the open file limit and as a fallback for peak RSS
+except ImportError:
+    resource = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LOCAL_HOST = "127.0.0.1"
+
+class OriginHandler(http.server.BaseHTTPRequestHandler):
+    """Stand-in origin server answering every GET with the same generated body"""
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True # Headers and body are separate writes, Nagle would hold the body back for a delayed ACK
+
+    def do_GET(self):
+        body, encoding = self.server.body, self.server.encoding
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg" if self.path.endswith(".jpg") else "application/octet-stream")
+        self.send_header("Cache-Control", "max-age=60" if self.server.cacheable else "no-store")
+        if encoding == "chunked":
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for start in range(0, len(body), 16384):
+                piece = body[start:start + 16384]
+                self.wfile.write(b"%x\r\n" % len(piece) + piece + b"\r\n")
+            self.wfile.write(b"0\r\n\r\n")
+        elif encoding == "close":
+            self.send_header("Connection", "close") # Body ends when the connection does
+            self.end_headers()
+            self.wfile.write(body)
+            self.close_connection = True
+        else:
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Keep the benchmark output readable
+
+def start_origin(port, size, encoding, cacheable):
+    """Start the stand-in origin on a background thread"""
+    server = http.server.ThreadingHTTPServer((LOCAL_HOST, port), OriginHandler)
+    server.daemon_threads = True
+    server.body, server.encoding, server.cacheable = os.urandom(size), encoding, cacheable
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def start_proxy(port, mode, workers):
+    """Run proxy.py in its own process on the given port, returning once it accepts connections"""
+    code = (f"import proxy; proxy.PORT = {port}; proxy.PROXY_MODE = {mode!r}; proxy.WORKER_PROCESSES = {workers}; "
+            f"proxy.start_proxy()")
+    process = subprocess.Popen([sys.executable, "-c", code], cwd=HERE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((LOCAL_HOST, port), timeout=1).close()
+            return process
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError(f"Proxy did not start listening on port {port}")
+
+def peak_rss_kb(process):
+    """Peak resident memory of the proxy and its worker processes in KiB, read from /proc while they are still running"""
+    total = None
+    for pid in [process.pid] + child_pids(process.pid):
+        try:
+            with open(f"/proc/{pid}/status") as status:
+                for line in status:
+                    if line.startswith("VmHWM:"):
+                        total = (total or 0) + int(line.split()[1])
+        except OSError:
+            pass
+    return total
+
+def child_pids(parent):
+    """Pids of the direct children of a process, found by scanning /proc"""
+    children = []
+    for entry in os.listdir("/proc") if os.path.isdir("/proc") else []:
+        try:
+            with open(f"/proc/{entry}/stat") as stat:
+                fields = stat.read().rsplit(")", 1)[1].split() # The command name in brackets may contain spaces
+        except (OSError, IndexError):
+            continue
+        if int(fields[1]) == parent:
+            children.append(int(entry))
+    return children
+
+def exited_peak_rss_kb():
+    """Peak resident memory of the largest waited-for child, for systems without /proc"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak # macOS reports bytes, Linux KiB
+
+def scenario_request(scenario, origin_port, index):
+    """Raw request for one step of a scenario"""
+    if scenario == "google":
+        return b"GET http://www.google.com/ HTTP/1.1\r\nHost: www.google.com\r\n\r\n"
+    path = f"/images/{index}.jpg" if scenario == "image" else f"/data/{index % 100}"
+    host = f"{LOCAL_HOST}:{origin_port}"
+    return f"GET http://{host}{path} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode()
+
+def read_response(sock):
+    """Read one response, returning (time its first byte arrived, whether the connection can carry another request)"""
+    data = bytearray()
+    first_byte = None
+    while b"\r\n\r\n" not in data:
+        chunk = sock.recv(65536)
+        if not chunk:
+            raise ConnectionError("Connection closed before the response head")
+        if first_byte is None:
+            first_byte = time.perf_counter()
+        data += chunk
+
+    head, _, body = bytes(data).partition(b"\r\n\r\n")
+    fields = {}
+    for line in head.split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        fields[name.strip().lower()] = value.strip().lower()
+
+    if b"content-length" in fields:
+        remaining = int(fields[b"content-length"]) - len(body)
+        while remaining > 0:
+            chunk = sock.recv(min(remaining, 65536))
+            if not chunk:
+                raise ConnectionError("Connection closed mid-body")
+            remaining -= len(chunk)
+        return first_byte, fields.get(b"connection") != b"close"
+
+    if b"chunked" in fields.get(b"transfer-encoding", b""):
+        tail = body[-5:]
+        while tail != b"0\r\n\r\n": # The stand-in origin never sends trailers, so this is how its bodies end
+            chunk = sock.recv(65536)
+            if not chunk:
+                raise ConnectionError("Connection closed mid-body")
+            tail = (tail + chunk)[-5:]
+        return first_byte, fields.get(b"connection") != b"close"
+
+    while sock.recv(65536): # Close-delimited body
+        pass
+    return first_byte, False
+
+def run_connection(proxy_port, scenario, origin_port, requests, deadline, latencies, ttfbs, errors):
+    """Send requests one after another, reusing the connection while the proxy keeps it open"""
+    sock = None
+    sent = 0
+    try:
+        while sent < requests and time.perf_counter() < deadline:
+            if sock is None:
+                sock = socket.create_connection((LOCAL_HOST, proxy_port), timeout=30)
+            start = time.perf_counter()
+            sock.sendall(scenario_request(scenario, origin_port, sent))
+            first_byte, keep_alive = read_response(sock)
+            latencies.append(time.perf_counter() - start)
+            ttfbs.append(first_byte - start)
+            sent += 1
+            if not keep_alive: # Replacement memes close the connection, like a browser we open another one
+                sock.close()
+                sock = None
+    except OSError as e:
+        errors.append(str(e))
+    finally:
+        if sock is not None:
+            sock.close()
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+def run(proxy_port, scenario, origin_port, connections, requests, duration):
+    """Drive one scenario with concurrent connections and return a summary of throughput and latency"""
+    latencies = [[] for _ in range(connections)] # one list per thread, so no locking is needed while running
+    ttfbs = [[] for _ in range(connections)]
+    errors = []
+
+    start = time.perf_counter()
+    deadline = start + duration if duration else float("inf")
+    threads = [threading.Thread(target=run_connection, args=(proxy_port, scenario, origin_port, requests, deadline,
+                                                             latencies[i], ttfbs[i], errors))
+               for i in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    merged = sorted(latency for per_connection in latencies for latency in per_connection)
+    merged_ttfb = sorted(ttfb for per_connection in ttfbs for ttfb in per_connection)
+    return {
+        "requests": len(merged),
+        "errors": len(errors),
+        "elapsed": elapsed,
+        "rps": len(merged) / elapsed if elapsed else 0.0,
+        "p50": percentile(merged, 0.50),
+        "p99": percentile(merged, 0.99),
+        "ttfb_p50": percentile(merged_ttfb, 0.50),
+        "ttfb_p99": percentile(merged_ttfb, 0.99),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the meme proxy against a local stand-in origin")
+    parser.add_argument("--scenarios", default="get,image,google", help="comma separated from get, image and google")
+    parser.add_argument("-c", "--connections", type=int, default=16, help="concurrent clients")
+    parser.add_argument("-n", "--requests", type=int, default=500, help="requests per client")
+    parser.add_argument("-d", "--duration", type=float, default=0, help="stop each scenario after this many seconds (0 = no limit)")
+    parser.add_argument("--size", type=int, default=16384, help="bytes in each origin response body")
+    parser.add_argument("--encoding", choices=["length", "chunked", "close"], default="length",
+                        help="how the origin frames its bodies: Content-Length, chunked or closing the connection")
+    parser.add_argument("--cacheable", action="store_true", help="let the proxy cache origin responses")
+    parser.add_argument("--mode", default="threaded", help="proxy serving mode to start, threaded or asyncio")
+    parser.add_argument("--workers", type=int, default=0, help="pre-fork worker processes for the proxy (0 = single process)")
+    parser.add_argument("--proxy-port", type=int, default=8081)
+    parser.add_argument("--origin-port", type=int, default=9090)
+    parser.add_argument("--external", action="store_true", help="benchmark a proxy already listening on --proxy-port")
+    args = parser.parse_args()
+
+    if resource is not None:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard)) # Every client needs a socket
+
+    origin = start_origin(args.origin_port, args.size, args.encoding, args.cacheable)
+    process = None if args.external else start_proxy(args.proxy_port, args.mode, args.workers)
+    rss = None
+    try:
+        for scenario in args.scenarios.split(","):
+            summary = run(args.proxy_port, scenario, args.origin_port, args.connections, args.requests, args.duration)
+            print(f"[{scenario}] {summary['requests']} requests ({summary['errors']} errors) in {summary['elapsed']:.2f}s, "
+                  f"{summary['rps']:.1f} requests/sec")
+            print(f"[{scenario}] Latency p50: {summary['p50'] * 1000:.2f} ms, p99: {summary['p99'] * 1000:.2f} ms, "
+                  f"TTFB p50: {summary['ttfb_p50'] * 1000:.2f} ms, p99: {summary['ttfb_p99'] * 1000:.2f} ms")
+        if process is not None:
+            rss = peak_rss_kb(process)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        origin.shutdown()
+
+    if process is not None:
+        rss = rss if rss is not None else exited_peak_rss_kb()
+        print(f"Proxy peak RSS: {rss / 1024:.1f} MiB" if rss is not None else "Proxy peak RSS: not available on this OS")
+
+if __name__ == "__main__":
+    main()
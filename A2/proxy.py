@@ -1,56 +1,519 @@
 import socket
 import threading
-from urllib.parse import urlparse
+import asyncio
+import sys
+import signal
 import errno
 import os, random, mimetypes
+import select
+import selectors
+import mmap
+import time
+import hashlib
+import bisect
+import json
+import gzip
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+
+try:
+    import resource # Unix only, used to raise the open file limit for the asyncio engine
+except ImportError:
+    resource = None
+
+try:
+    import brotli # Optional, br is offered alongside gzip when it is installed
+except ImportError:
+    brotli = None
 
 HOST = "127.0.0.1"
 DELAY = 1.0
 PORT = 8080
+PROXY_MODE = "threaded" # "threaded" starts a thread per client, "asyncio" serves every client from one event loop
+ASYNC_MAX_CONNECTIONS = 10000 # Most clients the asyncio engine serves at once, later ones queue for a slot
+ASYNC_LISTEN_BACKLOG = socket.SOMAXCONN # Pending connections the OS queues for the asyncio engine
+MAX_CONNECTIONS = 512 # Most clients the threaded engine serves at once, each one holds a thread
+LISTEN_BACKLOG = 128 # Pending connections the OS queues for the threaded engine
+ADMISSION_QUEUE_LIMIT = 256 # Connections allowed to wait for a free slot, past this new ones get an immediate 503
+ADMISSION_QUEUE_TIMEOUT = 2 # Seconds a queued connection waits for a slot before it gets a 503
+CLIENT_MAX_CONNECTIONS = None # Open connections allowed per client IP, more get a 429. None means no limit
+CLIENT_RATE = None # Requests per second each client IP may sustain, more get a 429. None means no limit
+CLIENT_BURST = 100 # Requests a client IP may send at once before CLIENT_RATE applies
+CLIENT_TRACK_MAX = 10000 # Client IPs whose request rate is tracked, least recently seen ones are forgotten past this
+RETRY_AFTER = 1 # Seconds clients are told to wait before retrying after a 429 or 503
+WORKER_PROCESSES = 0 # Pre-fork worker processes sharing PORT through SO_REUSEPORT, 0 serves everything from this process
+WORKER_STATS_INTERVAL = 1 # Seconds between each worker's stats reports to the master process
+SHUTDOWN_DRAIN_TIMEOUT = 30 # Seconds connections in progress get to finish once shutdown starts
+ASYNC_UPSTREAM_WORKERS = 64 # Worker threads the asyncio engine proxies requests on, the most that talk to remote servers at once
 CHUNK_SIZE = 1024
+REQUEST_BUFFER_SIZE = 4096 # Starting size of the buffer a request is read into, it grows as needed
+REQUEST_HEADER_LIMIT = 64 * 1024 # Largest request head accepted, bigger ones are refused with 431
+REQUEST_BODY_BUFFER = 1024 * 1024 # Request bodies up to this size are read whole, larger ones are streamed to the remote server
+REQUEST_CHUNKED_LIMIT = 16 * 1024 * 1024 # Chunked request bodies are decoded whole before forwarding, larger ones are refused with 413
+UPLOAD_BUFFER_SIZE = 64 * 1024 # Buffer used to stream large request bodies from the client to the remote server
+CHUNK_LINE_LIMIT = 8192 # Longest chunk-size or trailer line accepted in a chunked body
+STREAM_RESPONSES = True # Relay remote responses to the client as they arrive instead of buffering them whole
+POOL_CONNECTIONS = True # Keep remote connections open and reuse them for later requests to the same host:port
+POOL_MAX_IDLE = 8 # Most idle connections kept per host:port
+POOL_IDLE_TIMEOUT = 30 # Seconds an idle pooled connection is trusted before it gets closed instead of reused
+CLIENT_IDLE_TIMEOUT = 30 # Seconds a persistent client connection may wait for its next request
+PRELOAD_MEMES = True # Load the Memes directory once and serve replacements from memory instead of reading files per request
+MEME_RELOAD_INTERVAL = 5 # Seconds between checks of the Memes directory for added or removed files
+CACHE_RESPONSES = True # Answer repeated GETs from a local copy while the origin says it is still fresh
+CACHE_MAX_BYTES = 64 * 1024 * 1024 # Memory tier size, least recently used responses are evicted past this
+CACHE_MAX_OBJECT_BYTES = 8 * 1024 * 1024 # Larger responses are relayed without being cached
+CACHE_DIR = None # Directory for the on-disk tier, None keeps the cache in memory only
+CACHE_DISK_MAX_BYTES = 512 * 1024 * 1024 # Disk tier size, oldest files are removed past this
+COMPRESS_RESPONSES = True # gzip (or br) text responses for clients that accept it when the origin sent them uncompressed
+COMPRESS_MIN_BYTES = 1024 # Smaller bodies are sent as they are, the saving would not be worth the work
+COMPRESS_LEVEL = 6 # zlib level for compressing on the fly, cached copies are compressed once at the highest level
+COMPRESSIBLE_TYPES = (b"text/", b"application/json", b"application/javascript", b"application/xml",
+                      b"application/xhtml+xml", b"image/svg+xml") # Content-Type prefixes worth compressing
+TUNNEL_HTTPS = True # Open a CONNECT tunnel for HTTPS requests instead of answering them with a 501
+TUNNEL_CONNECT_TIMEOUT = 10 # Seconds to wait for the target of a CONNECT request to accept
+TUNNEL_IDLE_TIMEOUT = 300 # Seconds a tunnel may go without traffic in either direction before it is closed
+TUNNEL_BUFFER_SIZE = 64 * 1024 # Bytes held per tunnel direction before we stop reading from the sending side
+TUNNEL_SPLICE = hasattr(os, "splice") # Move tunnel bytes through a kernel pipe instead of copying them into Python
+DNS_CACHE = True # Remember resolved addresses instead of calling getaddrinfo for every remote connection
+DNS_TTL = 60 # Seconds an answer is kept when the resolver does not say (the OS resolver never does)
+DNS_NEGATIVE_TTL = 5 # Seconds a failed lookup is remembered, so a bad host name is not retried on every request
+DNS_REFRESH_AHEAD = 0.8 # Fraction of its TTL after which a name still in use is re-resolved in the background
+DNS_CACHE_MAX_ENTRIES = 1024 # Least recently used names are dropped past this
+METRICS_PORT = 8089 # Local port answering GET /metrics with the counters and timers as JSON, None turns it off
+VERBOSE = False # Print per-request detail, can be flipped while running with GET /trace/on or /trace/off on METRICS_PORT
+LATENCY_BUCKETS_MS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500] # upper bounds, last bucket is open
 # Due to the separate threads, we need to have a system for which thread can access the image counter
 image_counter_lock = threading.Lock() 
 image_counter = 0
 
 activeThreads = []
 
-def recv_http_request(sock):
-    """Receive function for an arbitrary HTTP request so we can get all of it"""
-    data = b""
+# Client sockets waiting for their next request. A drain shuts these down instead of waiting out CLIENT_IDLE_TIMEOUT
+waiting_clients = set()
+waiting_lock = threading.Lock()
+draining = False
+
+# Pre-fork master only: worker pid -> {"index", "started", "fd", "pending", "latest"}, plus the stats of workers that exited
+workers = {}
+retired_stats = {}
+WORKER_BIND_FAILED = 3 # Exit code of a worker that could not listen, restarting it would not help
+
+# Counters and per-stage timing histograms, see stats_snapshot
+stats_lock = threading.Lock()
+latency_stats = {} # stage -> {"count", "total", "max", "buckets"}
+traffic_stats = dict.fromkeys([
+    "requests", "bad_requests", "forwarded", "cache_hits", "revalidated", "image_replaced", "google_replaced",
+    "https_tunnelled", "https_rejected", "upstream_errors", "pool_reused", "tunnels_open",
+    "client_bytes_in", "client_bytes_out", "upstream_bytes_in", "upstream_bytes_out", "tunnel_bytes",
+    "compressed_responses", "compression_saved_bytes", "shed_overloaded", "shed_client_limit", "rate_limited"], 0)
+
+# Admission control: connections being served and waiting for a slot, open connections per client IP and their token buckets
+admission_lock = threading.Lock()
+admission = {"active": 0, "waiting": 0}
+client_connections = {} # IP -> open connections, only while CLIENT_MAX_CONNECTIONS is set
+client_buckets = OrderedDict() # IP -> (tokens, monotonic time they were counted), least recently seen first
+
+# Resolved names: (host, port) -> entry dict, least recently used first. Lookups in progress have an Event others can wait on
+dns_cache = OrderedDict()
+dns_lock = threading.Lock()
+dns_inflight = {}
+dns_counters = {"hits": 0, "misses": 0, "negative_hits": 0, "refreshes": 0, "failures": 0}
+dns_resolver = None # function(host, port) -> (list of (family, type, proto, sockaddr), TTL or None), None uses the OS resolver
+
+# Idle keep-alive connections to remote servers: (host, port) -> list of (socket, time it was returned)
+connection_pool = {}
+pool_lock = threading.Lock()
+
+# Preloaded memes: dicts with the prebuilt response header and the mapped file, swapped out whole on reload
+meme_store = []
+meme_store_mtime = None
+
+# Cached responses: absolute URL (see cache_key) -> entry dict, least recently used first, plus the bytes they take up in memory and on disk
+response_cache = OrderedDict()
+cache_lock = threading.Lock()
+cache_bytes = 0
+cache_disk_bytes = None # Worked out from CACHE_DIR the first time the disk tier is written to
+
+# Open tunnels are all pumped by one thread: new ones wait in pending_tunnels until it wakes up and registers them
+tunnel_selector = None
+tunnel_wakeup = None # (read end, write end) of a socket pair used to wake the pump thread
+pending_tunnels = []
+tunnel_lock = threading.Lock()
+
+def trace(message):
+    """Per-request detail, only printed while VERBOSE is on"""
+    if VERBOSE:
+        print(message)
+
+def record_latency(name, seconds):
+    """Add one timing to the histogram for a stage"""
+    milliseconds = seconds * 1000
+    with stats_lock:
+        histogram = latency_stats.get(name)
+        if histogram is None:
+            histogram = latency_stats[name] = {"count": 0, "total": 0.0, "max": 0.0, "buckets": [0] * (len(LATENCY_BUCKETS_MS) + 1)}
+        histogram["count"] += 1
+        histogram["total"] += milliseconds
+        histogram["max"] = max(histogram["max"], milliseconds)
+        histogram["buckets"][bisect.bisect_left(LATENCY_BUCKETS_MS, milliseconds)] += 1
+
+def count_stat(name, amount=1):
+    """Bump one of the traffic counters"""
+    with stats_lock:
+        traffic_stats[name] += amount
+
+def stats_snapshot():
+    """Copy of every counter and histogram, plus the state of the caches and pools, ready to be sent as JSON"""
+    with stats_lock:
+        latencies = {}
+        for name, histogram in latency_stats.items():
+            latencies[name] = {
+                "count": histogram["count"],
+                "avg_ms": round(histogram["total"] / histogram["count"], 3),
+                "max_ms": round(histogram["max"], 3),
+                "buckets": list(histogram["buckets"]),
+            }
+        snapshot = dict(traffic_stats, latency_ms=latencies, bucket_bounds_ms=LATENCY_BUCKETS_MS)
+    with cache_lock:
+        snapshot["cache"] = {"entries": len(response_cache), "bytes": cache_bytes}
+    with pool_lock:
+        snapshot["pool_idle"] = sum(len(idle) for idle in connection_pool.values())
+    snapshot["dns"] = dns_cache_stats()
+    with admission_lock:
+        snapshot["admission"] = dict(admission, clients=len(client_connections))
+    snapshot["verbose"] = VERBOSE
+    return snapshot
+
+def set_verbose(on):
+    """Switch per-request tracing on or off, in every worker process too when running pre-forked"""
+    global VERBOSE
+    VERBOSE = on
+    for pid in workers:
+        os.kill(pid, signal.SIGUSR1 if on else signal.SIGUSR2)
+
+def answer_metrics(client_socket):
+    """Answer one request on the metrics port: /metrics, /trace/on or /trace/off"""
     try:
-        while True:
-            chunk = sock.recv(CHUNK_SIZE)
-            if not chunk:
-                break
-            data += chunk
-            if len(chunk) < CHUNK_SIZE:
-                # If we received less than a full buffer, likely we're done
-                break
-    except socket.error as e:
-        print(f"Error receiving data: {e}")
-    print(data)
-    return data
+        client_socket.settimeout(5)
+        request = parse_request(recv_http_request(client_socket))
+        if request is None:
+            return
+        if request.target == b"/metrics":
+            body = json.dumps(prefork_snapshot() if workers else stats_snapshot(), indent=2).encode()
+        elif request.target in (b"/trace/on", b"/trace/off"):
+            set_verbose(request.target == b"/trace/on")
+            body = json.dumps({"verbose": VERBOSE}).encode()
+        else:
+            client_socket.sendall(status_response(b"404 Not Found"))
+            return
+        client_socket.sendall(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                              b"Content-Length: %d\r\nConnection: close\r\n\r\n" % len(body) + body)
+    except socket.error:
+        pass
+    finally:
+        client_socket.close()
 
-def is_https_request(request):
-    """Check if the request is an HTTPS CONNECT request"""
-    request_lines = request.split(b'\r\n')
-    if not request_lines:
+def serve_metrics(m_socket):
+    """Background thread answering the metrics port, one short request at a time"""
+    while True:
+        client_socket, _ = m_socket.accept()
+        answer_metrics(client_socket)
+
+def open_metrics():
+    """Listening socket for the metrics port, or None if it cannot be opened (the proxy runs on without metrics)"""
+    m_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    m_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        m_socket.bind((HOST, METRICS_PORT))
+        m_socket.listen(5)
+    except OSError as e:
+        print(f"Metrics unavailable, could not listen on {HOST}:{METRICS_PORT}: {e.strerror}")
+        m_socket.close()
+        return None
+    print(f"Metrics on http://{HOST}:{METRICS_PORT}/metrics")
+    return m_socket
+
+def start_metrics():
+    """Open the metrics port and answer it from a background thread"""
+    m_socket = open_metrics()
+    if m_socket is not None:
+        threading.Thread(target=serve_metrics, args=(m_socket,), daemon=True).start()
+
+def merge_snapshots(snapshots):
+    """Combine stats snapshots from several processes: counters, histograms and cache/DNS figures are summed"""
+    merged = dict.fromkeys(traffic_stats, 0)
+    merged.update(latency_ms={}, bucket_bounds_ms=LATENCY_BUCKETS_MS, cache={}, dns={}, admission={}, pool_idle=0)
+    for snapshot in snapshots:
+        for name in traffic_stats:
+            merged[name] += snapshot.get(name, 0)
+        merged["pool_idle"] += snapshot.get("pool_idle", 0)
+        for section in ("cache", "dns", "admission"):
+            for name, value in snapshot.get(section, {}).items():
+                merged[section][name] = merged[section].get(name, 0) + value
+        for name, histogram in snapshot.get("latency_ms", {}).items():
+            total = merged["latency_ms"].setdefault(
+                name, {"count": 0, "avg_ms": 0.0, "max_ms": 0.0, "buckets": [0] * (len(LATENCY_BUCKETS_MS) + 1)})
+            count = total["count"] + histogram["count"]
+            if count:
+                total["avg_ms"] = round((total["avg_ms"] * total["count"] + histogram["avg_ms"] * histogram["count"]) / count, 3)
+            total["count"] = count
+            total["max_ms"] = max(total["max_ms"], histogram["max_ms"])
+            total["buckets"] = [a + b for a, b in zip(total["buckets"], histogram["buckets"])]
+    return merged
+
+def prefork_snapshot():
+    """Stats of the whole pre-forked proxy: the latest report of every live worker plus what exited workers had counted"""
+    snapshot = merge_snapshots([retired_stats] + [worker["latest"] for worker in workers.values()])
+    snapshot["workers"] = [{"pid": pid, "index": worker["index"], "uptime": round(time.monotonic() - worker["started"], 1)}
+                           for pid, worker in sorted(workers.items())]
+    snapshot["worker_restarts"] = retired_stats.get("restarts", 0)
+    snapshot["verbose"] = VERBOSE
+    return snapshot
+
+def parse_client_request(data):
+    """Parse a received request and count it, returning the ParsedRequest or None if it is malformed"""
+    started = time.perf_counter()
+    request = parse_request(data)
+    record_latency("parse", time.perf_counter() - started)
+    count_stat("requests")
+    count_stat("client_bytes_in", len(data))
+    if request is None:
+        count_stat("bad_requests")
+    return request
+
+def new_request_state(pending = b""):
+    """Reader state for one client request, fed by request_space and request_received.
+
+    pending is what the client already sent past its previous request, the caller feeds it in with request_received."""
+    buffer = bytearray(max(REQUEST_BUFFER_SIZE, len(pending)))
+    buffer[:len(pending)] = pending
+    return {"buffer": buffer, "received": 0, "phase": "head", "total": None,
+            "chunked": None, "expect_continue": False, "error": None}
+
+def request_space(state):
+    """Writable part of the request buffer for the next recv_into, growing the buffer when it is full"""
+    buffer = state["buffer"]
+    if state["received"] == len(buffer):
+        size = min(len(buffer) * 2, REQUEST_HEADER_LIMIT) if state["phase"] == "head" else len(buffer) * 2
+        buffer.extend(bytes(size - len(buffer)))
+    end = state["total"] if state["phase"] == "body" else len(buffer)
+    return memoryview(buffer)[state["received"]:end]
+
+def request_received(state, count):
+    """Advance the reader over count newly received bytes, returning whether more need to be read"""
+    if count == 0:
+        state["phase"] = "closed"
         return False
+    state["received"] += count
+    buffer, received = state["buffer"], state["received"]
+
+    if state["phase"] == "head":
+        head_end = buffer.find(b"\r\n\r\n", max(0, received - count - 3), received)
+        if head_end == -1:
+            if received >= REQUEST_HEADER_LIMIT:
+                state["phase"], state["error"] = "error", b"431 Request Header Fields Too Large"
+            return state["phase"] == "head"
+
+        # The head is complete, its framing headers decide how much of the body comes next
+        head_end += 4
+        head = bytes(buffer[:head_end])
+        try:
+            content_length, chunked = parse_body_headers(head)
+        except ValueError:
+            state["phase"], state["error"] = "error", b"400 Bad Request"
+            return False
+        if chunked:
+            state["phase"], state["chunked"] = "chunked", new_chunked_state()
+            count = received - head_end # Scan the body bytes that arrived along with the head
+        elif content_length:
+            # Bodies past REQUEST_BODY_BUFFER are only read in part here, forward_request streams the rest
+            state["phase"], state["total"] = "body", head_end + min(content_length, REQUEST_BODY_BUFFER)
+            if state["total"] > len(buffer):
+                buffer.extend(bytes(state["total"] - len(buffer))) # One allocation for the whole body
+        elif head.split(b" ", 1)[0].upper() == b"CONNECT":
+            state["phase"], state["total"] = "done", received # Bytes after a CONNECT head belong to the tunnel
+            return False
+        else:
+            state["phase"], state["total"] = "done", head_end
+            return False
+        state["expect_continue"] = received == head_end and b"\r\nexpect: 100-continue" in head.lower()
+
+    if state["phase"] == "body":
+        if received >= state["total"]:
+            state["phase"] = "done"
+        return state["phase"] == "body"
+
+    try:
+        end = scan_chunked(state["chunked"], memoryview(buffer)[:received], received - count)
+    except ValueError: # Chunk size that is not hex, or a chunk line past CHUNK_LINE_LIMIT
+        state["phase"], state["error"] = "error", b"400 Bad Request"
+        return False
+    if end != -1:
+        state["phase"], state["total"] = "done", end
+    elif received > REQUEST_CHUNKED_LIMIT:
+        state["phase"], state["error"] = "error", b"413 Content Too Large"
+    return state["phase"] == "chunked"
+
+def request_bytes(state):
+    """The request a finished reader collected, or b"" if the client closed early or it was refused"""
+    return bytes(state["buffer"][:state["total"]]) if state["phase"] == "done" else b""
+
+def request_leftover(state):
+    """Bytes read past the end of a finished request, the start of the next one if the client pipelines them"""
+    return bytes(state["buffer"][state["total"]:state["received"]]) if state["phase"] == "done" else b""
+
+def status_response(status, retry_after = None):
+    """Minimal response with no body that closes the connection, e.g. for errors"""
+    retry = b"Retry-After: %d\r\n" % retry_after if retry_after is not None else b""
+    return b"HTTP/1.1 " + status + b"\r\n" + retry + b"Content-Length: 0\r\nConnection: close\r\n\r\n"
+
+def recv_http_request(sock, connection = None):
+    """Receive one HTTP request: the head up to REQUEST_HEADER_LIMIT, then its body as framed by its headers.
+
+    connection is a dict kept for the whole client connection, its "pending" bytes carry pipelined requests over."""
+    pending = connection["pending"] if connection else b""
+    state = new_request_state(pending)
+    waiting = connection is not None and not pending
+    if waiting and not start_waiting(sock):
+        return b"" # Shutting down, the client can send this request again on a new connection
+    try:
+        more = request_received(state, len(pending)) if pending else True
+        if waiting:
+            try:
+                more = request_received(state, sock.recv_into(request_space(state)))
+            finally:
+                stop_waiting(sock)
+        while more:
+            if state["expect_continue"]: # The client waits for this before sending its body
+                state["expect_continue"] = False
+                sock.sendall(b"HTTP/1.1 100 Continue\r\n\r\n")
+            more = request_received(state, sock.recv_into(request_space(state)))
+        if connection is not None:
+            connection["pending"] = request_leftover(state)
+        if state["error"]:
+            trace(f"Refusing request: {state['error'].decode()}")
+            count_stat("bad_requests")
+            sock.sendall(status_response(state["error"]))
+    except socket.error as e:
+        trace(f"Error receiving data: {e}")
+        return b""
+    return request_bytes(state)
+
+def start_waiting(sock):
+    """Mark a client socket as waiting for its next request, or return False if the proxy is draining"""
+    with waiting_lock:
+        if draining:
+            return False
+        waiting_clients.add(sock)
+        return True
+
+def stop_waiting(sock):
+    """The client sent the first bytes of a request (or left), a drain now lets that request finish"""
+    with waiting_lock:
+        waiting_clients.discard(sock)
+
+def close_waiting_clients():
+    """Start draining: shut down every client waiting for its next request, only requests in progress are waited for"""
+    global draining
+    with waiting_lock: # Held throughout, so a client that has just started a request is not cut off
+        draining = True
+        for sock in waiting_clients:
+            try:
+                sock.shutdown(socket.SHUT_RDWR) # Wakes the reader blocked on it with end of file
+            except OSError:
+                pass # Already closed by its own thread
+
+class ParsedRequest:
+    """A client request parsed once, with its header lines kept as byte offsets into the received buffer"""
+    __slots__ = ("buffer", "method", "target", "version", "headers", "body_start", "body_remaining", "host", "port", "path",
+                 "keep_alive")
+
+    def header(self, name):
+        """Value of a header given its lowercase name (repeated headers are comma-joined), or None if it is absent"""
+        values = [self.buffer[start:end].partition(b":")[2].strip() for header, start, end in self.headers if header == name]
+        return b", ".join(values) if values else None
+
+def parse_request(data):
+    """Parse a request in a single pass over its head, returning a ParsedRequest or None if it has no request line"""
+    line_end = data.find(b"\r\n")
+    head_end = data.find(b"\r\n\r\n")
+    if head_end == -1:
+        head_end = len(data)
+    if line_end == -1 or line_end > head_end:
+        line_end = head_end
+
+    parts = data[:line_end].split(b" ")
+    if len(parts) < 2 or not parts[0]:
+        return None
+
+    request = ParsedRequest()
+    request.buffer = data
+    request.method, request.target = parts[0], parts[1]
+    request.version = parts[2] if len(parts) > 2 else b"HTTP/1.0"
+    request.body_start = min(head_end + 4, len(data))
+    request.keep_alive = request.version == b"HTTP/1.1" # HTTP/1.1 connections are persistent unless they say otherwise
+
+    # Each header line is kept as (lowercase name, start, end), end being where its CRLF starts
+    request.headers = []
+    host_header = None
+    closed = False
+    content_length = None
+    start = line_end + 2
+    while start < head_end:
+        end = data.find(b"\r\n", start, head_end)
+        if end == -1:
+            end = head_end
+        name, sep, value = data[start:end].partition(b":")
+        if sep:
+            name = name.strip().lower()
+            request.headers.append((name, start, end))
+            if name == b"host":
+                host_header = value.strip()
+            elif name == b"content-length" and value.strip().isdigit():
+                content_length = int(value)
+            elif name in (b"connection", b"proxy-connection"):
+                tokens = [token.strip() for token in value.lower().split(b",")]
+                closed = closed or b"close" in tokens
+                request.keep_alive = request.keep_alive or b"keep-alive" in tokens
+        start = end + 2
+    request.keep_alive = request.keep_alive and not closed
+    # Body bytes recv_http_request left on the client socket for forward_request to stream through
+    request.body_remaining = max(0, (content_length or 0) - (len(data) - request.body_start))
+
+    # Work out where the request goes: CONNECT names host:port, proxies get absolute URLs, anything else uses Host
+    target = request.target
+    request.path = None
+    if request.method.upper() == b"CONNECT":
+        authority, default_port = target, 443
+    elif target[:7].lower() == b"http://":
+        authority, slash, path = target[7:].partition(b"/")
+        request.path = slash + path if slash else b"/"
+        default_port = 80
+    else:
+        authority, request.path, default_port = host_header or b"", target, 80
+    if request.path is not None:
+        request.path = request.path.split(b"#", 1)[0] or b"/" # Fragments are never sent to the server
 
-    first_line = request_lines[0].decode('utf-8', errors='ignore')
-    method = first_line.split(' ')[0].upper()
+    authority = authority.rpartition(b"@")[2] # Drop any user:password@
+    host, port = authority, b""
+    if authority.startswith(b"["): # IPv6 literal, the port follows the closing bracket
+        host, _, rest = authority[1:].partition(b"]")
+        port = rest[1:] if rest.startswith(b":") else b""
+    elif authority.count(b":") == 1:
+        host, _, port = authority.partition(b":")
+    request.host = host.decode('latin-1').lower() or None
+    request.port = int(port) if port.isdigit() else default_port
+    return request
 
-    return method == "CONNECT"
+def is_https_request(request):
+    """Check if the request is an HTTPS CONNECT request"""
+    return request.method.upper() == b"CONNECT"
 
 def handle_https_request(request):
     """Generates and returns response for HTTPS request"""
-    # Extract the target host and port from the CONNECT request
-    request_line = request.split(b'\r\n')[0].decode('utf-8')
-    target = request_line.split(' ')[1]
-    host, port = target.split(':')
-    port = int(port)
-
-    print(f"HTTPS connection request detected to {host}:{port}")
+    trace(f"HTTPS connection request detected to {request.host}:{request.port}")
 
     response = b"HTTP/1.1 501 Not Implemented\r\n"
     response += b"Content-Type: text/plain\r\n"
@@ -59,6 +522,183 @@ def handle_https_request(request):
 
     return response
 
+def open_tunnel(client_socket, request):
+    """Connect to the target of a CONNECT request and hand both sockets to the tunnel pump"""
+    host, port = request.host, request.port
+    if not host:
+        client_socket.sendall(status_response(b"400 Bad Request"))
+        return
+
+    trace(f"HTTPS connection request detected to {host}:{port}")
+    try:
+        remote_socket = connect_remote(host, port, timeout=TUNNEL_CONNECT_TIMEOUT)
+    except (socket.gaierror, OSError) as e:
+        trace(f"Could not open tunnel to {host}:{port}: {e}")
+        count_stat("upstream_errors")
+        client_socket.sendall(status_response(b"502 Bad Gateway"))
+        return
+
+    client_socket.sendall(b"HTTP/1.1 200 Connection Established\r\n\r\n")
+    early = request.buffer[request.body_start:] # Anything the client sent after the CONNECT head belongs to the tunnel
+    if early:
+        remote_socket.sendall(early)
+
+    # Detach the client so handle_client's close() leaves it alone, the pump owns it from here
+    trace(f"Tunnel open between {client_socket.getpeername()} and {host}:{port}.")
+    count_stat("https_tunnelled")
+    count_stat("tunnels_open")
+    add_tunnel(socket.socket(fileno=client_socket.detach()), remote_socket)
+
+def new_tunnel_direction(source, destination):
+    """One way of a tunnel: bytes read from source wait in a buffer (or kernel pipe) until destination takes them"""
+    direction = {"source": source, "destination": destination, "pending": 0, "eof": False, "done": False,
+                 "buffer": bytearray(), "pipe": None}
+    if TUNNEL_SPLICE:
+        direction["pipe"] = os.pipe()
+        for fd in direction["pipe"]:
+            os.set_blocking(fd, False)
+    return direction
+
+def add_tunnel(client_socket, remote_socket):
+    """Queue a connected client/target pair for the pump thread, starting the thread the first time"""
+    global tunnel_selector, tunnel_wakeup
+
+    client_socket.setblocking(False)
+    remote_socket.setblocking(False)
+    tunnel = {
+        "upstream": new_tunnel_direction(client_socket, remote_socket),
+        "downstream": new_tunnel_direction(remote_socket, client_socket),
+        "sockets": (client_socket, remote_socket),
+        "events": {client_socket: 0, remote_socket: 0}, # What each socket is currently registered for
+        "last_active": time.monotonic(),
+    }
+
+    with tunnel_lock:
+        if tunnel_selector is None:
+            tunnel_selector = selectors.DefaultSelector()
+            tunnel_wakeup = socket.socketpair()
+            tunnel_wakeup[0].setblocking(False)
+            tunnel_selector.register(tunnel_wakeup[0], selectors.EVENT_READ)
+            threading.Thread(target=pump_tunnels, daemon=True).start()
+        pending_tunnels.append(tunnel)
+    tunnel_wakeup[1].send(b"\0")
+
+def pump_tunnels():
+    """Single thread moving bytes for every open tunnel, only reading from a side while its buffer has room"""
+    tunnels = []
+    last_sweep = time.monotonic()
+    while True:
+        for key, mask in tunnel_selector.select(timeout=1):
+            if key.data is None:
+                # Woken up by add_tunnel, take over the tunnels it queued
+                try:
+                    tunnel_wakeup[0].recv(CHUNK_SIZE)
+                except BlockingIOError:
+                    pass
+                with tunnel_lock:
+                    new, pending_tunnels[:] = pending_tunnels[:], []
+                for tunnel in new:
+                    tunnels.append(tunnel)
+                    update_tunnel_events(tunnel)
+                continue
+
+            tunnel, sock = key.data
+            if tunnel["sockets"] is None:
+                continue # Closed earlier in this same round of events
+            try:
+                if mask & selectors.EVENT_READ:
+                    fill_tunnel_direction(tunnel["upstream" if sock is tunnel["sockets"][0] else "downstream"])
+                if mask & selectors.EVENT_WRITE:
+                    drain_tunnel_direction(tunnel["downstream" if sock is tunnel["sockets"][0] else "upstream"])
+            except OSError as e:
+                trace(f"Tunnel error: {e}")
+                close_tunnel(tunnel)
+                continue
+            tunnel["last_active"] = time.monotonic()
+            if tunnel["upstream"]["done"] and tunnel["downstream"]["done"]:
+                close_tunnel(tunnel)
+            else:
+                update_tunnel_events(tunnel)
+
+        now = time.monotonic()
+        if now - last_sweep >= 1:
+            last_sweep = now
+            for tunnel in tunnels:
+                if tunnel["sockets"] is not None and now - tunnel["last_active"] > TUNNEL_IDLE_TIMEOUT:
+                    trace("Closing idle tunnel.")
+                    close_tunnel(tunnel)
+            tunnels = [tunnel for tunnel in tunnels if tunnel["sockets"] is not None]
+
+def fill_tunnel_direction(direction):
+    """Read what fits into a direction's buffer from its source, noting when the source has finished sending"""
+    room = TUNNEL_BUFFER_SIZE - direction["pending"]
+    try:
+        if direction["pipe"]:
+            received = os.splice(direction["source"].fileno(), direction["pipe"][1], room,
+                                 flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        else:
+            data = direction["source"].recv(room)
+            direction["buffer"] += data
+            received = len(data)
+    except BlockingIOError:
+        return
+    if received == 0:
+        direction["eof"] = True
+    direction["pending"] += received
+    count_stat("tunnel_bytes", received)
+    drain_tunnel_direction(direction) # Usually the destination can take it straight away
+
+def drain_tunnel_direction(direction):
+    """Write a direction's buffered bytes to its destination, passing the end of stream on once it is empty"""
+    try:
+        while direction["pending"]:
+            if direction["pipe"]:
+                sent = os.splice(direction["pipe"][0], direction["destination"].fileno(), direction["pending"],
+                                 flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            else:
+                sent = direction["destination"].send(direction["buffer"])
+                del direction["buffer"][:sent]
+            direction["pending"] -= sent
+    except BlockingIOError:
+        return
+    if direction["eof"] and not direction["done"]:
+        direction["done"] = True
+        direction["destination"].shutdown(socket.SHUT_WR) # Half-close, the other direction may still be talking
+
+def update_tunnel_events(tunnel):
+    """Register each socket for reading while its outgoing buffer has room and for writing while its incoming one has data"""
+    client_socket, remote_socket = tunnel["sockets"]
+    for sock, outgoing, incoming in ((client_socket, tunnel["upstream"], tunnel["downstream"]),
+                                     (remote_socket, tunnel["downstream"], tunnel["upstream"])):
+        events = 0
+        if not outgoing["eof"] and outgoing["pending"] < TUNNEL_BUFFER_SIZE:
+            events |= selectors.EVENT_READ
+        if incoming["pending"]:
+            events |= selectors.EVENT_WRITE
+
+        registered = tunnel["events"][sock]
+        if events == registered:
+            continue
+        if not registered:
+            tunnel_selector.register(sock, events, (tunnel, sock))
+        elif not events:
+            tunnel_selector.unregister(sock)
+        else:
+            tunnel_selector.modify(sock, events, (tunnel, sock))
+        tunnel["events"][sock] = events
+
+def close_tunnel(tunnel):
+    """Close both sockets and any kernel pipes of a tunnel"""
+    for sock in tunnel["sockets"]:
+        if tunnel["events"][sock]:
+            tunnel_selector.unregister(sock)
+        sock.close()
+    for direction in (tunnel["upstream"], tunnel["downstream"]):
+        for fd in direction["pipe"] or ():
+            os.close(fd)
+    tunnel["sockets"] = None
+    count_stat("tunnels_open", -1)
+
 def recv_http_response(sock):
     """Receive function to ensure we receive the entire response (headers + body)"""
     # Read header data into byte buffer
@@ -74,39 +714,712 @@ def recv_http_response(sock):
     headers = headers_data[:header_end] # Separate headers and first part of body
     body = headers_data[header_end:]
 
-    # Parse headers to find Content-Length or Transfer-Encoding
-    header_lines = headers.split(b"\r\n")
-    content_length = 0
+    try:
+        # Parse headers to find Content-Length or Transfer-Encoding
+        content_length, chunked = parse_body_headers(headers)
+
+        # Handle remote response based on the way the body is encoded
+        if headers.split(b" ", 2)[1:2] in ([b"204"], [b"304"]):
+            pass # These responses never carry a body
+        elif chunked:
+            # Keep the chunked framing as it is, just read until the last chunk and its trailers have arrived
+            state = new_chunked_state()
+            end = scan_chunked(state, body)
+            if end != -1:
+                body = body[:end]
+            while end == -1:
+                chunk = sock.recv(CHUNK_SIZE)
+                if not chunk:
+                    break # Connection closed early
+                end = scan_chunked(state, chunk)
+                body += chunk if end == -1 else chunk[:end]
+        elif content_length is not None:
+            current_length = len(body)
+        
+            # Continue receiving until the current amount of bytes that has been read is == content-length
+            while current_length < content_length:
+                chunk = sock.recv(CHUNK_SIZE)
+                if not chunk:
+                    break # Connection closed early
+                body += chunk
+                current_length += len(chunk)
+        else: # No content length or chunked encoding so we read until connection closes
+            while True:
+                chunk = sock.recv(CHUNK_SIZE)
+                if not chunk:
+                    break
+                body += chunk
+
+    except ValueError as e:
+        trace(f"Malformed response framing: {e}") # Pass on what arrived, the caller closes the connection afterwards
+
+    return headers + body
+
+def chunk_size(line):
+    """Size a chunk-size line gives, raising ValueError unless it is hex digits (anything after ; is a chunk extension)"""
+    size = line.split(b";", 1)[0].strip()
+    if not size or size.strip(b"0123456789abcdefABCDEF"): # int() alone would also take signs, 0x and underscores
+        raise ValueError(f"Bad chunk size: {size[:32].decode('latin-1')}")
+    return int(size, 16)
+
+def new_chunked_state():
+    """Parser state for scan_chunked, kept across reads of one chunked body"""
+    return {"phase": "size", "remaining": 0, "line": b""}
+
+def scan_chunked(state, data, start=0):
+    """Follow a chunked body through the next piece of data, returning the index in data just past its end (or -1).
+
+    Only chunk-size lines and trailers are looked at, chunk data is skipped over without being copied."""
+    position = start
+    while position < len(data):
+        if state["phase"] == "data":
+            step = min(state["remaining"], len(data) - position)
+            position += step
+            state["remaining"] -= step
+            if state["remaining"] == 0:
+                state["phase"] = "size"
+            continue
+
+        # Size and trailer lines may be split across reads, so collect them until their newline shows up
+        piece = bytes(data[position:position + CHUNK_LINE_LIMIT])
+        newline = piece.find(b"\n")
+        if newline == -1:
+            state["line"] += piece
+            position += len(piece)
+            if len(state["line"]) > CHUNK_LINE_LIMIT:
+                raise ValueError("Chunk line too long")
+            continue
+
+        line = (state["line"] + piece[:newline]).strip()
+        state["line"] = b""
+        position += newline + 1
+        if state["phase"] == "size":
+            size = chunk_size(line)
+            if size == 0:
+                state["phase"] = "trailer"
+            else:
+                state["phase"], state["remaining"] = "data", size + 2 # The data is followed by its own CRLF
+        elif not line: # Blank line after the trailers ends the body
+            return position
+
+    return -1
+
+def decode_chunked(body):
+    """Decode a complete chunked body into plain bytes, dropping any trailers"""
+    decoded = bytearray()
+    position = 0
+    while True:
+        line_end = body.find(b"\r\n", position)
+        if line_end == -1:
+            raise ValueError("Incomplete chunked body")
+        size = chunk_size(body[position:line_end])
+        position = line_end + 2
+        if size == 0:
+            return bytes(decoded)
+        decoded += body[position:position + size]
+        position += size + 2
+
+def parse_body_headers(headers):
+    """Find how the body of a message is delimited: returns (content length or None, whether it is chunked).
+
+    Raises ValueError for a Content-Length that is not all digits or that disagrees with an earlier one."""
+    content_length = None
     chunked = False
 
-    for line in header_lines:
-        if b"content-length:" in line.lower():
-            content_length = int(line.split(b":", 1)[1].strip())
-        elif line.lower().startswith(b"transfer-encoding:") and b"chunked" in line.lower():
+    for line in headers.split(b"\r\n")[1:]: # Skip the request or status line
+        name, sep, value = line.partition(b":")
+        if not sep:
+            continue
+        name, value = name.strip().lower(), value.strip()
+        if name == b"content-length":
+            if not value.isdigit() or content_length not in (None, int(value)):
+                raise ValueError(f"Bad Content-Length: {value.decode('latin-1')}")
+            content_length = int(value)
+        elif name == b"transfer-encoding" and b"chunked" in value.lower():
             chunked = True
 
-    # Handle remote response based on the way the body is encoded
-    if chunked:
-        print("Proxy does not offer support for chunked encoding.")
+    return content_length, chunked
+
+def relay_http_response(remote_sock, client_sock, method=b"GET", capture=None, timings=None, coding=None, head=b""):
+    """Forward the remote response to the client as it arrives.
+
+    Returns (bytes relayed or None if nothing came back, whether the remote connection can carry another request).
+    A connection that is closed or reset before the first response byte gives None, the usual sign of a stale pooled one.
+    If capture is a bytearray it receives a copy of the response, unless that grows past CACHE_MAX_OBJECT_BYTES.
+    If timings is a dict, the perf_counter time of the first response byte is stored in it as "first_byte".
+    coding is a content coding the client accepts (see accepted_coding), uncompressed text bodies are sent in it and
+    the bytes this saved are stored in timings as "bytes_saved". head is any start of the response already read."""
+    # One reusable buffer for the whole relay, so no new bytes object is built per chunk
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    relayed = 0
+    reusable = False
+    headers_data = bytearray(head)
+
+    try:
+        # Read until the end of the headers, we need them to know how the body ends
+        header_end = headers_data.find(b"\r\n\r\n")
+        while header_end == -1:
+            received = remote_sock.recv_into(buffer)
+            if timings is not None and not headers_data:
+                timings["first_byte"] = time.perf_counter()
+            if not received:
+                if headers_data: # Remote closed early, pass along whatever it did send
+                    client_sock.sendall(headers_data)
+                    return len(headers_data), False
+                return None, False
+            search_from = max(0, len(headers_data) - 3) # The blank line may straddle two reads
+            headers_data += view[:received]
+            header_end = headers_data.find(b"\r\n\r\n", search_from)
+
+        header_end += 4 # +4 tells us where the end of the headers is
+        headers = bytes(headers_data[:header_end])
+        content_length, chunked = parse_body_headers(headers)
+
+        status_line = headers.split(b"\r\n", 1)[0].split(b" ")
+        if method == b"HEAD" or (len(status_line) > 1 and status_line[1] in (b"204", b"304")):
+            content_length, chunked = 0, False # These responses never carry a body, whatever their headers say
+
+        if chunked:
+            # Chunks are passed through untouched as they arrive, the scanner only tracks where the body ends
+            state = new_chunked_state()
+            end = scan_chunked(state, headers_data, header_end)
+            client_sock.sendall(headers_data if end == -1 else headers_data[:end])
+            relayed = len(headers_data) if end == -1 else end
+            extra = end != -1 and end < len(headers_data)
+            while end == -1:
+                received = remote_sock.recv_into(buffer)
+                if not received:
+                    break # Connection closed early
+                end = scan_chunked(state, view[:received])
+                client_sock.sendall(view[:received if end == -1 else end])
+                relayed += received if end == -1 else end
+                extra = end != -1 and end < received
+
+            # Anything the server sent past the final chunk means we lost track, so the connection is not reused
+            return relayed, end != -1 and not extra and is_keep_alive(headers, status_line[0])
+
+        if coding and status_line[1:2] == [b"200"] and should_compress(headers, content_length):
+            relayed, reusable, saved = relay_compressed(remote_sock, client_sock, headers_data, header_end,
+                                                        content_length, coding, capture, view)
+            if timings is not None:
+                timings["bytes_saved"] = saved
+            return relayed, reusable and is_keep_alive(headers, status_line[0])
+
+        # Headers and any body that came with them go out straight away
+        client_sock.sendall(headers_data)
+        relayed = len(headers_data)
+        if capture is not None:
+            capture += headers_data
+
+        if content_length is not None:
+            remaining = content_length - (len(headers_data) - header_end)
+            while remaining > 0:
+                received = remote_sock.recv_into(view[:min(CHUNK_SIZE, remaining)])
+                if not received:
+                    break # Connection closed early
+                client_sock.sendall(view[:received])
+                relayed += received
+                remaining -= received
+                if capture is not None:
+                    if len(capture) + received > CACHE_MAX_OBJECT_BYTES:
+                        del capture[:] # Too big to cache, stop copying
+                        capture = None
+                    else:
+                        capture += view[:received]
+
+            # Only a response that ended exactly where its length said leaves the connection ready for another request
+            reusable = remaining == 0 and is_keep_alive(headers, status_line[0])
+        else: # No content length or chunked encoding so we relay until the connection closes
+            while True:
+                received = remote_sock.recv_into(buffer)
+                if not received:
+                    break
+                client_sock.sendall(view[:received])
+                relayed += received
+    except socket.error as e:
+        trace(f"Error relaying response: {e}")
+        if not headers_data:
+            return None, False # Nothing reached the client yet, so the request can still be retried
+        reusable = False
+    except ValueError as e:
+        trace(f"Malformed response framing: {e}")
+        reusable = False
+
+    return relayed, reusable
+
+def relay_compressed(remote_sock, client_sock, headers_data, header_end, content_length, coding, capture, view):
+    """Relay a response body compressed with coding as it arrives, chunked since its compressed size is not known yet.
+
+    Returns (bytes received from the remote server, whether the body ended where its length said, bytes saved).
+    capture receives the response as the origin sent it, so the cache keeps the uncompressed copy."""
+    feed, finish = new_compressor(coding)
+    head = encoded_head(bytes(headers_data[:header_end - 4]), coding, b"Transfer-Encoding: chunked") + b"\r\n\r\n"
+    client_sock.sendall(head)
+    sent = len(head) + send_chunk(client_sock, feed(bytes(headers_data[header_end:])))
+    relayed = len(headers_data)
+    remaining = None if content_length is None else content_length - (len(headers_data) - header_end)
+    if capture is not None and content_length is not None:
+        capture += headers_data
+    else:
+        capture = None # A close-delimited response is never cached
+
+    while remaining is None or remaining > 0:
+        received = remote_sock.recv_into(view[:CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining)])
+        if not received:
+            break # Connection closed, which ends a close-delimited body
+        sent += send_chunk(client_sock, feed(bytes(view[:received])))
+        relayed += received
+        if remaining is not None:
+            remaining -= received
+        if capture is not None:
+            if len(capture) + received > CACHE_MAX_OBJECT_BYTES:
+                del capture[:] # Too big to cache, stop copying
+                capture = None
+            else:
+                capture += view[:received]
+
+    sent += send_chunk(client_sock, finish())
+    client_sock.sendall(b"0\r\n\r\n")
+    sent += 5
+    count_stat("compressed_responses")
+    count_stat("compression_saved_bytes", relayed - sent)
+    return relayed, remaining == 0, relayed - sent
+
+def send_chunk(sock, data):
+    """Send data as one chunk of a chunked body, returning the bytes it took on the wire"""
+    if not data:
+        return 0 # An empty chunk would end the body
+    size_line = b"%x\r\n" % len(data)
+    send_buffers(sock, [size_line, data, b"\r\n"])
+    return len(size_line) + len(data) + 2
+
+def accepted_coding(request):
+    """Content coding to compress responses to this client with, "br" or "gzip", or None to send them as they are"""
+    value = request.header(b"accept-encoding")
+    if not COMPRESS_RESPONSES or not value:
         return None
-    elif content_length:
-        current_length = len(body)
-        
-        # Continue receiving until the current amount of bytes that has been read is == content-length
-        while current_length < content_length:
-            chunk = sock.recv(CHUNK_SIZE)
-            if not chunk:
-                break # Connection closed early
-            body += chunk
-            current_length += len(chunk)
-    else: # No content length or chunked encoding so we read until connection closes
-        while True:
-            chunk = sock.recv(CHUNK_SIZE)
-            if not chunk:
-                break
-            body += chunk
 
-    return headers + body
+    qualities = {}
+    for part in value.lower().split(b","):
+        coding, _, parameters = part.partition(b";")
+        parameters = parameters.strip()
+        try:
+            qualities[coding.strip()] = float(parameters[2:]) if parameters.startswith(b"q=") else 1.0
+        except ValueError:
+            qualities[coding.strip()] = 0.0 # An unreadable weight is safest read as "not acceptable"
+    for coding in ([b"br"] if brotli is not None else []) + [b"gzip"]:
+        if qualities.get(coding, qualities.get(b"*", 0)) > 0:
+            return coding.decode()
+    return None
+
+def should_compress(headers, content_length):
+    """Whether a response with these headers is worth compressing, and allowed to be changed by the proxy"""
+    fields = header_fields(headers)
+    content_type = fields.get("content-type", "").strip().lower().encode('latin-1')
+    if "content-encoding" in fields or "no-transform" in cache_directives(fields.get("cache-control", "")):
+        return False
+    if content_length is not None and content_length < COMPRESS_MIN_BYTES:
+        return False
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+def new_compressor(coding):
+    """(feed, finish) functions of a streaming compressor for coding"""
+    if coding == "br":
+        compressor = brotli.Compressor(quality=5) # Brotli's top levels are far too slow for on-the-fly use
+        return compressor.process, compressor.finish
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 31) # wbits 31 writes the gzip header and trailer
+    return compressor.compress, compressor.flush
+
+def compress_body(body, coding):
+    """Whole body compressed with coding at the highest level, for copies that are compressed once and reused"""
+    if coding == "br":
+        return brotli.compress(bytes(body))
+    return gzip.compress(body, compresslevel=9, mtime=0)
+
+def encoded_head(head, coding, framing):
+    """Response head (without its blank line) rewritten for a body compressed with coding.
+
+    framing is the new Content-Length or Transfer-Encoding line, since the old one described the uncompressed body."""
+    lines = []
+    for line in head.split(b"\r\n"):
+        name, _, value = line.partition(b":")
+        name = name.strip().lower()
+        if name in (b"content-length", b"transfer-encoding"):
+            continue
+        if name == b"etag" and not value.strip().startswith(b"W/"):
+            line = b"ETag: W/" + value.strip() # The bytes differ from the origin's, so the validator can only be weak
+        lines.append(line)
+    lines.extend((b"Content-Encoding: " + coding.encode(), b"Vary: Accept-Encoding", framing))
+    return b"\r\n".join(lines)
+
+def is_keep_alive(headers, version):
+    """Whether a request or response with these headers leaves its connection open afterwards"""
+    keep_alive = version == b"HTTP/1.1" # HTTP/1.1 connections are persistent unless they say otherwise
+    for line in headers.split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        if name.strip().lower() in (b"connection", b"proxy-connection"):
+            tokens = [token.strip() for token in value.lower().split(b",")]
+            if b"close" in tokens:
+                return False
+            if b"keep-alive" in tokens:
+                keep_alive = True
+    return keep_alive
+
+def checkout_connection(host, port):
+    """Take a healthy idle connection to host:port out of the pool, or None if there is not one"""
+    while True:
+        with pool_lock:
+            idle = connection_pool.get((host, port))
+            if not idle:
+                return None
+            remote_socket, returned_at = idle.pop() # Most recently returned first, it is the least likely to be stale
+
+        if time.monotonic() - returned_at <= POOL_IDLE_TIMEOUT and connection_is_healthy(remote_socket):
+            return remote_socket
+        remote_socket.close()
+
+def connection_is_healthy(remote_socket):
+    """An idle connection should have nothing to read, if it is readable the server closed it or sent junk"""
+    try:
+        readable, _, _ = select.select([remote_socket], [], [], 0)
+    except (OSError, ValueError):
+        return False
+    return not readable
+
+def checkin_connection(host, port, remote_socket):
+    """Put a connection back in the pool once its response has been fully read"""
+    now = time.monotonic()
+    with pool_lock:
+        idle = connection_pool.setdefault((host, port), [])
+        expired = [entry for entry in idle if now - entry[1] > POOL_IDLE_TIMEOUT]
+        idle[:] = [entry for entry in idle if now - entry[1] <= POOL_IDLE_TIMEOUT]
+        pooled = len(idle) < POOL_MAX_IDLE
+        if pooled:
+            idle.append((remote_socket, now))
+
+    for old_socket, _ in expired:
+        old_socket.close()
+    if not pooled:
+        remote_socket.close()
+
+def system_resolver(host, port):
+    """Resolve through getaddrinfo, which does not report TTLs so DNS_TTL applies"""
+    infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    return [(family, type_, proto, sockaddr) for family, type_, proto, _, sockaddr in infos], None
+
+def resolve(host, port):
+    """Addresses for host:port from the DNS cache, looking them up (once, however many threads ask) if missing or expired"""
+    resolver = dns_resolver or system_resolver
+    if not DNS_CACHE:
+        return resolver(host, port)[0]
+
+    key = (host, port)
+    while True:
+        now = time.monotonic()
+        with dns_lock:
+            entry = dns_cache.get(key)
+            if entry is not None and now < entry["expires"]:
+                dns_cache.move_to_end(key)
+                if entry["error"] is not None:
+                    dns_counters["negative_hits"] += 1
+                    raise socket.gaierror(*entry["error"].args)
+                dns_counters["hits"] += 1
+                if now >= entry["refresh_at"] and not entry["refreshing"]:
+                    # Still in use close to expiring, refresh it now so requests never wait on the lookup
+                    entry["refreshing"] = True
+                    dns_counters["refreshes"] += 1
+                    threading.Thread(target=lookup_host, args=(key,), daemon=True).start()
+                return entry["addresses"]
+
+            waiting = dns_inflight.get(key)
+            if waiting is None:
+                dns_inflight[key] = threading.Event()
+                dns_counters["misses"] += 1
+        if waiting is None:
+            break
+        waiting.wait() # Another thread is already looking this name up, use its answer
+
+    entry = lookup_host(key)
+    if entry["error"] is not None:
+        raise socket.gaierror(*entry["error"].args)
+    return entry["addresses"]
+
+def lookup_host(key):
+    """Resolve key and store the answer, or the failure, in the DNS cache"""
+    host, port = key
+    try:
+        try:
+            addresses, ttl = (dns_resolver or system_resolver)(host, port)
+            error = None if addresses else socket.gaierror(socket.EAI_NONAME, "No addresses found")
+        except (socket.gaierror, UnicodeError) as e: # Names too long for IDNA fail with UnicodeError
+            addresses, ttl, error = [], None, e if isinstance(e, socket.gaierror) else socket.gaierror(socket.EAI_NONAME, str(e))
+
+        now = time.monotonic()
+        ttl = DNS_NEGATIVE_TTL if error is not None else DNS_TTL if ttl is None else ttl
+        entry = {"addresses": addresses, "error": error, "expires": now + ttl,
+                 "refresh_at": now + ttl * DNS_REFRESH_AHEAD, "refreshing": False}
+        with dns_lock:
+            old = dns_cache.get(key)
+            if error is not None:
+                dns_counters["failures"] += 1
+                if old is not None and old["error"] is None and now < old["expires"]:
+                    # A failed background refresh does not throw away an answer that is still valid, and waits
+                    # DNS_NEGATIVE_TTL before trying again so a resolver that is down is not asked on every hit
+                    old["refreshing"] = False
+                    old["refresh_at"] = min(now + DNS_NEGATIVE_TTL, old["expires"])
+                    return old
+            dns_cache[key] = entry
+            dns_cache.move_to_end(key)
+            while len(dns_cache) > DNS_CACHE_MAX_ENTRIES:
+                dns_cache.popitem(last=False)
+        return entry
+    finally:
+        with dns_lock:
+            waiting = dns_inflight.pop(key, None)
+        if waiting is not None:
+            waiting.set()
+
+def forget_host(host, port):
+    """Drop a cached name, e.g. when none of its addresses accept connections any more"""
+    with dns_lock:
+        dns_cache.pop((host, port), None)
+
+def dns_cache_stats():
+    """Snapshot of the DNS cache counters"""
+    with dns_lock:
+        return dict(dns_counters, entries=len(dns_cache))
+
+def connect_remote(host, port, timeout=None):
+    """Open a connection to host:port using the DNS cache, trying each address in turn like socket.create_connection"""
+    last_error = None
+    for family, type_, proto, sockaddr in resolve(host, port):
+        remote_socket = socket.socket(family, type_, proto)
+        remote_socket.settimeout(timeout)
+        try:
+            remote_socket.connect(sockaddr)
+            return remote_socket
+        except socket.error as e:
+            remote_socket.close()
+            last_error = e
+
+    forget_host(host, port) # The addresses may be out of date, look the name up again next time
+    raise last_error or socket.gaierror(socket.EAI_NONAME, "No addresses found")
+
+def header_fields(headers):
+    """Map of lowercased header names to values for a request or response head (repeated headers are comma-joined)"""
+    fields = {}
+    for line in headers.split(b"\r\n")[1:]:
+        name, sep, value = line.partition(b":")
+        if not sep:
+            continue
+        name = name.strip().lower().decode('latin-1')
+        value = value.strip().decode('latin-1')
+        fields[name] = fields[name] + ", " + value if name in fields else value
+    return fields
+
+def cache_directives(value):
+    """Cache-Control header value -> {directive: argument or None}"""
+    directives = {}
+    for part in value.split(","):
+        name, _, argument = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = argument.strip('"') or None
+    return directives
+
+def cache_key(request):
+    """Key a request can be cached under, or None if it must always go to the origin"""
+    if request.method != b"GET":
+        return None
+
+    cache_control = request.header(b"cache-control") or b""
+    if request.header(b"authorization") is not None or "no-store" in cache_directives(cache_control.decode('latin-1')):
+        return None
+    if not request.host or request.path is None:
+        return None
+    # Built from where the request is routed, so origin-form requests for different Hosts never share an entry
+    host = f"[{request.host}]" if ":" in request.host else request.host
+    return f"http://{host}:{request.port}{request.path.decode('latin-1')}"
+
+def freshness_lifetime(fields):
+    """Seconds a response may be served from the cache, or None if it may not be stored at all"""
+    directives = cache_directives(fields.get("cache-control", ""))
+    if "no-store" in directives or "private" in directives or "set-cookie" in fields:
+        return None
+    if fields.get("vary", "").strip(): # Variants are not tracked, so do not risk serving the wrong one
+        return None
+    if "no-cache" in directives:
+        return 0
+
+    for directive in ("s-maxage", "max-age"):
+        if directive in directives:
+            try:
+                return max(0, int(directives[directive]))
+            except (TypeError, ValueError):
+                return 0
+    if "expires" in fields:
+        try:
+            expires = parsedate_to_datetime(fields["expires"]).timestamp()
+            date = parsedate_to_datetime(fields["date"]).timestamp() if "date" in fields else time.time()
+            return max(0, expires - date)
+        except (TypeError, ValueError, IndexError):
+            return 0 # An invalid Expires means already expired
+
+    # No explicit lifetime, but a validator still lets us revalidate instead of downloading again
+    return 0 if "etag" in fields or "last-modified" in fields else None
+
+def store_response(key, response):
+    """Cache a complete 200 response captured while relaying it, if the origin allows that"""
+    head, sep, body = bytes(response).partition(b"\r\n\r\n")
+    if not sep or not head.startswith(b"HTTP/1.1 200") and not head.startswith(b"HTTP/1.0 200"):
+        return
+    fields = header_fields(head)
+    lifetime = freshness_lifetime(fields)
+    if lifetime is None or fields.get("content-length") != str(len(body)):
+        return # Not cacheable, or the body did not arrive in full
+
+    # Hop-by-hop headers describe the origin connection, not the response
+    lines = [line for line in head.split(b"\r\n")
+             if line.split(b":", 1)[0].strip().lower() not in (b"connection", b"keep-alive", b"proxy-connection")]
+    entry = {"head": b"\r\n".join(lines), "body": body, "fresh_until": time.time() + lifetime,
+             "lifetime": lifetime, "etag": fields.get("etag"), "last_modified": fields.get("last-modified")}
+    cache_put(key, add_encoded_variants(entry))
+    if CACHE_DIR:
+        write_disk_entry(key, entry)
+
+def add_encoded_variants(entry):
+    """Give a cache entry compressed copies of its body, made once here instead of on every hit, and return it"""
+    if not COMPRESS_RESPONSES or len(entry["body"]) < COMPRESS_MIN_BYTES or not should_compress(entry["head"], None):
+        return entry
+    variants = {}
+    for coding in (["br"] if brotli is not None else []) + ["gzip"]:
+        body = compress_body(entry["body"], coding)
+        if len(body) < len(entry["body"]): # Already dense data can come out bigger
+            variants[coding] = (encoded_head(entry["head"], coding, b"Content-Length: %d" % len(body)), body)
+    entry["encoded"] = variants
+    return entry
+
+def entry_size(entry):
+    """Bytes a cache entry takes up in memory, compressed copies included"""
+    return len(entry["head"]) + len(entry["body"]) + sum(len(head) + len(body) for head, body in entry.get("encoded", {}).values())
+
+def cache_put(key, entry):
+    """Add an entry to the memory tier, evicting least recently used entries to stay within CACHE_MAX_BYTES"""
+    global cache_bytes
+
+    size = entry_size(entry)
+    with cache_lock:
+        previous = response_cache.pop(key, None)
+        if previous is not None:
+            cache_bytes -= entry_size(previous)
+        response_cache[key] = entry
+        cache_bytes += size
+        while cache_bytes > CACHE_MAX_BYTES:
+            _, evicted = response_cache.popitem(last=False)
+            cache_bytes -= entry_size(evicted)
+
+def cache_get(key, disk = True):
+    """Cached entry for key from memory, falling back to the disk tier unless disk is False, or None"""
+    with cache_lock:
+        entry = response_cache.get(key)
+        if entry is not None:
+            response_cache.move_to_end(key)
+            return entry
+
+    if CACHE_DIR and disk:
+        entry = read_disk_entry(key)
+        if entry is not None:
+            cache_put(key, add_encoded_variants(entry)) # Promote to memory for next time, the disk only keeps the original
+        return entry
+    return None
+
+def disk_entry_path(key):
+    return os.path.join(CACHE_DIR, hashlib.sha256(key.encode('utf-8', 'surrogateescape')).hexdigest() + ".cache")
+
+def write_disk_entry(key, entry):
+    """Write an entry to the disk tier as a JSON metadata line followed by the raw head and body"""
+    global cache_disk_bytes
+
+    meta = {"key": key, "head_length": len(entry["head"]), "fresh_until": entry["fresh_until"],
+            "lifetime": entry["lifetime"], "etag": entry["etag"], "last_modified": entry["last_modified"]}
+    path = disk_entry_path(key)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(json.dumps(meta).encode() + b"\n" + entry["head"] + entry["body"])
+        old_size = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(temp_path, path) # Readers never see a half written file
+
+        with cache_lock:
+            if cache_disk_bytes is None:
+                cache_disk_bytes = sum(os.path.getsize(os.path.join(CACHE_DIR, name))
+                                       for name in os.listdir(CACHE_DIR) if name.endswith(".cache"))
+            else:
+                cache_disk_bytes += os.path.getsize(path) - old_size
+            over_budget = cache_disk_bytes > CACHE_DISK_MAX_BYTES
+        if over_budget:
+            prune_disk_cache()
+    except OSError as e:
+        print(f"Unable to write cache entry to disk: {e}")
+
+def read_disk_entry(key):
+    """Load an entry from the disk tier, or None if it is missing or unreadable"""
+    try:
+        with open(disk_entry_path(key), "rb") as f:
+            meta = json.loads(f.readline())
+            data = f.read()
+    except (OSError, ValueError):
+        return None
+    if meta.get("key") != key:
+        return None
+    head_length = meta.pop("head_length")
+    meta.pop("key")
+    return dict(meta, head=data[:head_length], body=data[head_length:])
+
+def prune_disk_cache():
+    """Remove the oldest disk tier files until it is back under CACHE_DISK_MAX_BYTES"""
+    global cache_disk_bytes
+
+    files = []
+    for name in os.listdir(CACHE_DIR):
+        if name.endswith(".cache"):
+            path = os.path.join(CACHE_DIR, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= CACHE_DISK_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+    with cache_lock:
+        cache_disk_bytes = total
+
+def cached_response(entry, keep_alive, coding = None):
+    """Full response to send a client for a cached entry, compressed if it has a copy in a coding the client accepts"""
+    connection = b"Connection: keep-alive" if keep_alive else b"Connection: close"
+    head, body = entry.get("encoded", {}).get(coding, (entry["head"], entry["body"]))
+    if body is not entry["body"]:
+        count_stat("compressed_responses")
+        count_stat("compression_saved_bytes", len(entry["body"]) - len(body))
+    return head + b"\r\n" + connection + b"\r\n\r\n" + body
+
+def cache_conditions(entry):
+    """Conditional header lines for forward_request so the origin can answer 304 if our copy is still good"""
+    conditions = []
+    if entry["etag"]:
+        conditions.append(b"If-None-Match: " + entry["etag"].encode('latin-1') + b"\r\n")
+    if entry["last_modified"]:
+        conditions.append(b"If-Modified-Since: " + entry["last_modified"].encode('latin-1') + b"\r\n")
+    return conditions
 
 def should_replace_this_image():
     """Thread-safe function to determine if we should replace the current image"""
@@ -114,283 +1427,1080 @@ def should_replace_this_image():
     with image_counter_lock:
         should_replace = (image_counter % 2 == 0) # Replace every 2 image requests (50% of them)
         image_counter += 1
-        print(f"Image counter: {image_counter}, replacing: {should_replace}")
+        trace(f"Image counter: {image_counter}, replacing: {should_replace}")
         return should_replace
 
 def is_image_request(request):
     """Check if the request is for an image"""
-    # Extract URL from request
-    request_lines = request.split(b"\r\n")
-    if not request_lines:
-        return False
-
-    first_line = request_lines[0].decode('utf-8', errors='ignore')
-    parts = first_line.split(' ')
-    if len(parts) < 2:
-        return False
-
     # Function just checks if the request url ends with any of the below filetypes
-    url = parts[1]
-    image_extensions = ['jpg', 'jpeg', 'png', 'gif', 'webp', 'svg']
-    return any(url.lower().endswith(ext) for ext in image_extensions)
+    url = request.target.lower()
+    image_extensions = [b'jpg', b'jpeg', b'png', b'gif', b'webp', b'svg']
+    return any(url.endswith(ext) for ext in image_extensions)
 
 def is_google_request(request):
     """Check if the request is for google.com or google.ca"""
-    request_lines = request.split(b'\r\n')
-    if not request_lines:
-        return False
+    return request.host in ['www.google.com', 'google.com', 'www.google.ca', 'google.ca']
 
-    # Check first line for URL
-    first_line = request_lines[0].decode('utf-8', errors='ignore')
-    parts = first_line.split(' ')
-    if len(parts) < 2:
-        return False
-
-    url = parts[1]
-
-    if url.startswith("http://"):
-        parsed_url = urlparse(url)
-        host = parsed_url.netloc
-    else:
-        # Check Host header
-        host = None
-        for line in request_lines[1:]:
-            line_str = line.decode('utf-8', errors='ignore')
-            if line_str.lower().startswith('host:'):
-                host = line_str.split(':', 1)[1].strip()
-                break
-
-    if host:
-        return host.lower() in ['www.google.com', 'google.com', 'www.google.ca', 'google.ca']
-
-    return False
-
-def create_image_response(meme_path):
-    """Create an HTTP response with the meme image"""
+def create_image_response(meme_path, coding = None):
+    """Create an HTTP response with the meme image, compressed with coding if it is a text format like SVG"""
     # Read the meme file
     with open(meme_path, 'rb') as f:
         image_data = f.read()
 
     # Determine content type
     content_type = mimetypes.guess_type(meme_path)[0] or 'image/jpeg'
-    print(f"Content-type: {content_type} for the following meme path: {meme_path}")
+    trace(f"Content-type: {content_type} for the following meme path: {meme_path}")
+
+    if coding and len(image_data) >= COMPRESS_MIN_BYTES and content_type.encode().startswith(COMPRESSIBLE_TYPES):
+        image_data = compress_body(image_data, coding)
+    else:
+        coding = None
+
+    # Combine headers and body
+    full_response = image_response_header(content_type, len(image_data), coding) + image_data
+    return full_response # return bytes for handle_client to send
 
-    # Build HTTP response
+def image_response_header(content_type, length, coding = None):
+    """Status line and headers for a meme response, up to and including the blank line"""
     response = []
     response.append(b"HTTP/1.1 200 OK")
     response.append(f"Content-Type: {content_type}".encode()) # .encode turns the string into byte
-    response.append(f"Content-Length: {len(image_data)}".encode())
+    response.append(f"Content-Length: {length}".encode())
+    if coding:
+        response.append(f"Content-Encoding: {coding}".encode())
+        response.append(b"Vary: Accept-Encoding")
     response.append(b"Connection: close")
     response.append(b"")  # Empty line to separate headers from body
-
-    # Combine headers and body
-    full_response = b'\r\n'.join(response) + b'\r\n' + image_data
-    return full_response # return bytes for handle_client to send
+    return b'\r\n'.join(response) + b'\r\n'
 
 def get_random_meme():
     """Get a random meme file path from the Memes directory"""
     return os.getcwd() + "/Memes/" + random.choice(os.listdir(os.getcwd()+"/Memes"))        
 
-def forward_request(request, host = "", port = 0):
-    """Alters and sends request to server specified in Host"""
+def load_meme_store():
+    """Map every file in the Memes directory into memory with its response header prebuilt"""
+    global meme_store, meme_store_mtime
+
+    memes_dir = os.path.join(os.getcwd(), "Memes")
     try:
-        if b"\r\n\r\n" in request:
-            headers_part, body_part = request.split(b"\r\n\r\n", 1)
-        else:
-            headers_part = request
-            body_part = b""
-
-        header_lines = headers_part.split(b"\r\n")
-
-        # Parse request searching for where to forward the request
-        first_line = header_lines[0]
-        url = first_line.split(b' ')[1]
-        parsed_url = urlparse(url.decode('utf-8'))
-
-        host = parsed_url.hostname # We get hostname from parsed url as well as the path
-        path = parsed_url.path + "?" + parsed_url.query if parsed_url.query else parsed_url.path
-        if not path: # If path is null, we just get the root of the webpage
-            path = "/"
-
-        # Port is 80 by default unless otherwise specified 
-        port = parsed_url.port if parsed_url.port else 80
-
-        # Proxy needs to alter the first line slightly before forwarding
-        modified_headers = []
-        modified_headers.append(first_line.split(b" ")[0] + b" " + path.encode() + b" " + first_line.split(b" ")[2])
-
-        has_host = False
-        has_content_length = False
-
-        for line in header_lines[1:]:
-            if line.startswith(b"Host:"):
-                has_host = True
-                modified_headers.append(line)
-            elif line.startswith(b"Content-Length:"):
-                has_content_length = True
-                if body_part:
-                    modified_headers.append(f"Content-Length: {len(body_part)}".encode())
-                else:
-                    modified_headers.append(line)
-            elif line.startswith(b"Transfer-Encoding:") and b'chunked' in line:
-                continue # do not add this header to new headers
-            else: # For any other headers, simply append them
-                modified_headers.append(line)
+        mtime = os.stat(memes_dir).st_mtime
+        names = sorted(os.listdir(memes_dir))
+    except OSError as e:
+        print(f"Unable to load memes from {memes_dir}: {e}")
+        return
+
+    memes = []
+    for name in names:
+        meme_path = os.path.join(memes_dir, name)
+        if not os.path.isfile(meme_path):
+            continue
+        try:
+            meme_file = open(meme_path, 'rb')
+            size = os.fstat(meme_file.fileno()).st_size
+            data = mmap.mmap(meme_file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        except (OSError, ValueError) as e:
+            print(f"Skipping meme {meme_path}: {e}")
+            continue
+
+        content_type = mimetypes.guess_type(meme_path)[0] or 'image/jpeg'
+        # The file stays open for sendfile, old stores are left for the garbage collector since a thread may still be sending one
+        meme = {"path": meme_path, "file": meme_file, "data": data, "size": size,
+                "header": image_response_header(content_type, size), "encoded": {}}
+        if COMPRESS_RESPONSES and size >= COMPRESS_MIN_BYTES and content_type.encode().startswith(COMPRESSIBLE_TYPES):
+            for coding in (["br"] if brotli is not None else []) + ["gzip"]:
+                body = compress_body(data, coding)
+                meme["encoded"][coding] = image_response_header(content_type, len(body), coding) + body
+        memes.append(meme)
+
+    meme_store, meme_store_mtime = memes, mtime # Replaced in one assignment, so readers see the old list or the new one
+    print(f"Loaded {len(memes)} memes from {memes_dir}.")
+
+def watch_meme_store():
+    """Background thread reloading the meme store whenever the Memes directory changes"""
+    while True:
+        time.sleep(MEME_RELOAD_INTERVAL)
+        try:
+            mtime = os.stat(os.path.join(os.getcwd(), "Memes")).st_mtime
+        except OSError:
+            continue
+        if mtime != meme_store_mtime:
+            load_meme_store()
 
-        if not has_host: # If there is no host specified
-            print("Unable to find a host to forward the request to.")
-            return None
+def send_meme(client_socket, meme):
+    """Send a preloaded meme: the prebuilt header, then the file through sendfile where the OS has it"""
+    client_socket.sendall(meme["header"])
+    count_stat("client_bytes_out", len(meme["header"]) + meme["size"])
+    if not hasattr(os, "sendfile"):
+        client_socket.sendall(meme["data"]) # The mapped file goes straight to the socket without a bytes copy
+        return
+
+    offset = 0
+    while offset < meme["size"]:
+        try:
+            sent = os.sendfile(client_socket.fileno(), meme["file"].fileno(), offset, meme["size"] - offset)
+        except BlockingIOError: # Socket has a timeout so it is non-blocking underneath, wait until it drains
+            _, writable, _ = select.select([], [client_socket], [], client_socket.gettimeout())
+            if not writable:
+                raise socket.timeout("timed out sending meme")
+            continue
+        if sent == 0:
+            break
+        offset += sent
+
+def send_replacement_meme(client_socket, coding = None):
+    """Answer the client with a random meme, returning whether one could be sent.
+
+    coding is a content coding the client accepts, text memes like SVGs are sent compressed with it."""
+    if PRELOAD_MEMES:
+        memes = meme_store
+        if not memes:
+            trace("No memes are loaded.")
+            return False
+        meme = random.choice(memes)
+        trace(f"Meme selected: {meme['path']}")
+        if coding in meme["encoded"]:
+            client_socket.sendall(meme["encoded"][coding])
+            count_stat("client_bytes_out", len(meme["encoded"][coding]))
+            return True
+        send_meme(client_socket, meme)
+        return True
+
+    meme_path = get_random_meme()
+    trace(f"Meme selected: {meme_path}")
+    if meme_path and os.path.exists(meme_path):
+        response = create_image_response(meme_path, coding)
+        if response:
+            client_socket.sendall(response)
+            count_stat("client_bytes_out", len(response))
+            return True
+    trace(f"Meme file not found or invalid: {meme_path}.")
+    return False
+
+def send_buffers(sock, buffers):
+    """Send a list of byte buffers in order, gathered into as few system calls as possible instead of joined first"""
+    if not hasattr(sock, "sendmsg"): # Windows has no sendmsg
+        sock.sendall(b"".join(buffers))
+        return
+
+    buffers = [memoryview(buffer) for buffer in buffers if len(buffer)]
+    while buffers:
+        sent = sock.sendmsg(buffers[:1024]) # Stay under the usual IOV_MAX
+        while sent:
+            if sent >= len(buffers[0]):
+                sent -= len(buffers.pop(0))
+            else:
+                buffers[0] = buffers[0][sent:]
+                sent = 0
+
+def stream_request_body(client_socket, remote_socket, remaining):
+    """Pass the rest of a large request body from the client to the remote server through one reusable buffer"""
+    buffer = memoryview(bytearray(min(remaining, UPLOAD_BUFFER_SIZE)))
+    while remaining:
+        received = client_socket.recv_into(buffer[:remaining])
+        if not received:
+            raise ConnectionError("Client closed the connection before sending its whole body")
+        remote_socket.sendall(buffer[:received])
+        count_stat("client_bytes_in", received)
+        remaining -= received
+
+def forward_request(request, fresh = False, conditions = None, client_socket = None):
+    """Alters and sends a parsed request to the server it is addressed to.
+
+    Returns (remote socket, (host, port), whether the socket came from the pool), or (None, None, False) on failure.
+    fresh skips the pool and always opens a new connection. conditions replaces the client's own If-None-Match and
+    If-Modified-Since headers, see cache_conditions. client_socket is where the part of a large body that
+    recv_http_request did not read is streamed from."""
+    host, port = request.host, request.port
+    try:
+        if not host or request.path is None: # If there is no host specified
+            trace("Unable to find a host to forward the request to.")
+            return None, None, False
 
-        if not has_content_length and body_part:
-            content_length_header = f"Content-Length: {len(body_part)}".encode()
-            modified_headers.append(content_length_header)
-        elif not has_content_length and not body_part:
-            modified_headers.append(b"Content-Length: 0")
+        view = memoryview(request.buffer)
+        body = view[request.body_start:]
+        if request.header(b"transfer-encoding") and b"chunked" in request.header(b"transfer-encoding").lower():
+            # A chunked request body is decoded here, it gets forwarded with a Content-Length instead
+            try:
+                body = decode_chunked(request.buffer[request.body_start:])
+            except ValueError:
+                trace("Malformed chunked request body.")
+                return None, None, False
 
-        modified_request = b"\r\n".join(modified_headers) + b"\r\n\r\n" + body_part
+        # Proxy needs to alter the first line slightly before forwarding, the path replaces the absolute URL
+        outgoing = [request.method, b" ", request.path, b" ", request.version, b"\r\n"]
+
+        # Header lines that pass through unchanged are sent as slices of the received buffer, runs of them as one slice
+        dropped = {b"transfer-encoding", b"content-length", b"expect"} # 100 Continue was already sent by recv_http_request
+        if POOL_CONNECTIONS:
+            dropped.update((b"connection", b"proxy-connection")) # The proxy decides for itself whether the remote connection stays open
+        if conditions is not None:
+            dropped.update((b"if-none-match", b"if-modified-since")) # The client's own conditions were about its copy, not ours
+        run_start = run_end = None
+        for name, start, end in request.headers:
+            if name in dropped:
+                if run_start is not None:
+                    outgoing.append(view[run_start:run_end])
+                    run_start = None
+                continue
+            if run_start is None:
+                run_start = start
+            run_end = end + 2
+        if run_start is not None:
+            outgoing.append(view[run_start:run_end])
+
+        if request.header(b"host") is None:
+            outgoing.append(f"Host: {host}\r\n".encode('latin-1'))
+        outgoing.append(f"Content-Length: {len(body) + request.body_remaining}\r\n".encode())
+        outgoing.extend(conditions or ())
+        if POOL_CONNECTIONS:
+            outgoing.append(b"Connection: keep-alive\r\n")
+        outgoing.append(b"\r\n")
+        outgoing.append(body)
 
         if not port or port <= 0:
-            print(f"Error regarding the host: {host} or port: {port}")
-            print(f"Host : {host}, Port: {port}")
-            return None  
-
-        remote_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        remote_socket.connect((host, port))
-        remote_socket.sendall(modified_request)
-        print(f"Client request forwarded to remote server: {host}")
-
-        return remote_socket
-    except IndexError:
-        print("Malformed HTTP request: Missing first line.")
-    except ValueError:
-        print("Invalid URL in request.")
+            trace(f"Error regarding the host: {host} or port: {port}")
+            trace(f"Host : {host}, Port: {port}")
+            return None, None, False
+
+        if request.body_remaining and client_socket is None:
+            trace("Request body is only partly received, nothing to stream the rest from.")
+            return None, None, False
+
+        # A streamed body cannot be sent a second time, so it never goes over a pooled connection that may be stale
+        remote_socket = checkout_connection(host, port) if POOL_CONNECTIONS and not fresh and not request.body_remaining else None
+        reused = remote_socket is not None
+        if reused:
+            try:
+                send_buffers(remote_socket, outgoing)
+            except socket.error: # The pooled connection went bad after all, fall back to a new one
+                remote_socket.close()
+                remote_socket, reused = None, False
+
+        if remote_socket is None:
+            started = time.perf_counter()
+            remote_socket = connect_remote(host, port)
+            record_latency("connect", time.perf_counter() - started)
+            send_buffers(remote_socket, outgoing)
+        else:
+            count_stat("pool_reused")
+        count_stat("upstream_bytes_out", sum(len(buffer) for buffer in outgoing) + request.body_remaining)
+        if request.body_remaining:
+            try:
+                stream_request_body(client_socket, remote_socket, request.body_remaining)
+            except socket.error:
+                remote_socket.close()
+                raise
+        trace(f"Client request forwarded to remote server: {host}")
+
+        return remote_socket, (host, port), reused
     except socket.gaierror:
-        print(f"DNS resolution failed for host: {host}.")
+        count_stat("upstream_errors")
+        trace(f"DNS resolution failed for host: {host}.")
     except socket.timeout:
-        print(f"Connection to {host}:{port} timed out.")
+        count_stat("upstream_errors")
+        trace(f"Connection to {host}:{port} timed out.")
     except socket.error as e:
-        print(f"Socket error encountered while forwarding request: {e}.")
+        count_stat("upstream_errors")
+        trace(f"Socket error encountered while forwarding request: {e}.")
 
-    return None
+    return None, None, False
+
+def admit_connection(ip, has_slot):
+    """Decide what to do with a new connection from ip: "serve" it, "queue" it for a slot, or the status to refuse it with.
+
+    has_slot says whether the caller already took a free slot for it, which is given back through finish_connection
+    unless the answer is "serve". Anything but a refusal must be followed by finish_connection(ip) once it is done."""
+    with admission_lock:
+        if CLIENT_MAX_CONNECTIONS and client_connections.get(ip, 0) >= CLIENT_MAX_CONNECTIONS:
+            count_stat("shed_client_limit")
+            return b"429 Too Many Requests"
+        if has_slot:
+            admission["active"] += 1
+        elif admission["waiting"] < ADMISSION_QUEUE_LIMIT:
+            admission["waiting"] += 1
+        else:
+            count_stat("shed_overloaded")
+            return b"503 Service Unavailable"
+        if CLIENT_MAX_CONNECTIONS:
+            client_connections[ip] = client_connections.get(ip, 0) + 1
+    return "serve" if has_slot else "queue"
+
+def leave_queue(got_slot):
+    """A queued connection either got a slot or waited ADMISSION_QUEUE_TIMEOUT in vain"""
+    with admission_lock:
+        admission["waiting"] -= 1
+        if got_slot:
+            admission["active"] += 1
+    if not got_slot:
+        count_stat("shed_overloaded")
+
+def finish_connection(ip, served):
+    """Forget a connection admit_connection let in, served says whether it got as far as holding a slot"""
+    with admission_lock:
+        if served:
+            admission["active"] -= 1
+        if CLIENT_MAX_CONNECTIONS and ip in client_connections:
+            client_connections[ip] -= 1
+            if not client_connections[ip]:
+                del client_connections[ip]
+
+def take_token(ip):
+    """Spend one of ip's request tokens, returning False if it has run out (CLIENT_RATE refills them)"""
+    if not CLIENT_RATE:
+        return True
+    now = time.monotonic()
+    with admission_lock:
+        tokens, counted = client_buckets.pop(ip, (CLIENT_BURST, now))
+        tokens = min(CLIENT_BURST, tokens + (now - counted) * CLIENT_RATE)
+        allowed = tokens >= 1
+        client_buckets[ip] = (tokens - 1 if allowed else tokens, now) # Re-inserted, so it is now the most recently seen
+        if len(client_buckets) > CLIENT_TRACK_MAX:
+            client_buckets.popitem(last=False)
+    if not allowed:
+        count_stat("rate_limited")
+    return allowed
+
+def shed_connection(client_socket, status):
+    """Refuse a connection straight away without ever blocking on it"""
+    try:
+        client_socket.setblocking(False)
+        client_socket.send(status_response(status, RETRY_AFTER)) # A few bytes, they fit in any empty send buffer
+        client_socket.recv(REQUEST_HEADER_LIMIT) # Closing with the request unread would reset the connection, losing the answer
+    except OSError:
+        pass
+    finally:
+        client_socket.close()
+
+def handle_admitted(client_socket, client_address, slots, queued):
+    """Thread body for a connection admit_connection let in: wait for a slot if it was queued, then serve it"""
+    served = not queued
+    try:
+        if queued:
+            served = slots.acquire(timeout=ADMISSION_QUEUE_TIMEOUT)
+            leave_queue(served)
+            if not served:
+                trace(f"No slot freed up for {client_address}, refusing it.")
+                shed_connection(client_socket, b"503 Service Unavailable")
+                return
+        try:
+            handle_client(client_socket, client_address)
+        finally:
+            slots.release()
+    finally:
+        finish_connection(client_address[0], served)
 
 def handle_client(client_socket, client_address):
     """Main functionality of proxy when a client has just connected"""
+    client_socket.settimeout(CLIENT_IDLE_TIMEOUT) # So idle persistent connections do not hold their thread forever
+
+    try:
+        # Persistent clients can send several requests over the same connection, serve them one after another
+        connection = {"pending": b""} # Bytes of pipelined requests read along with the one before them
+        while serve_request(client_socket, client_address, connection):
+            pass
+    except socket.error as e:
+        trace(f"Socket error encountered while serving {client_address}: {e}.")
+    finally:
+        client_socket.close()
+        trace(f"Connection closed with {client_address}.\n")
+
+def serve_request(client_socket, client_address, connection = None):
+    """Serve a single request from the client, returning whether the connection can be used for another one"""
     # Receive request from client
-    print("Receiving client request...")
-    request = recv_http_request(client_socket)
+    trace("Receiving client request...")
+    request = recv_http_request(client_socket, connection)
     if not request:
-        print("Received null request from client.")
-        client_socket.close()
-        return
+        trace("Received null request from client.")
+        return False
+    request = parse_client_request(request)
+    if request is None:
+        trace("Received malformed request from client.")
+        return False
 
-    if is_https_request(request):
-        response = handle_https_request(request)
+    action, response = classify_request(request, client_address)
+    if action == "refuse":
         client_socket.sendall(response)
-        print(f"Server cannot handle {client_address}'s HTTPS request.")
-        client_socket.close()
-        return 
+        return False
+    if action == "tunnel":
+        open_tunnel(client_socket, request)
+        return False # Either the tunnel owns the connection now or the client was told why it could not be opened
+    if action in ("google", "image"):
+        if not meme_fallthrough(action, send_replacement_meme(client_socket, accepted_coding(request))):
+            return False
+
+    key = cache_key(request) if CACHE_RESPONSES else None
+    entry = cache_get(key) if key is not None else None
+    response = cached_answer(request, key, entry)
+    if response is not None:
+        client_socket.sendall(response)
+        return request.keep_alive
+
+    return fetch_response(client_socket, client_address, request, key, entry, request.keep_alive)
+
+def classify_request(request, client_address):
+    """Decide how a parsed request is answered, for both serve_request and serve_request_async.
+
+    Returns (action, response): "refuse" with the response to send before closing, or "tunnel", "google", "image"
+    (answer with a meme) or "forward" with None."""
+    if not take_token(client_address[0]):
+        trace(f"{client_address} is over its request rate.")
+        return "refuse", status_response(b"429 Too Many Requests", RETRY_AFTER)
+
+    if is_https_request(request):
+        if TUNNEL_HTTPS:
+            return "tunnel", None
+        count_stat("https_rejected")
+        trace(f"Server cannot handle {client_address}'s HTTPS request.")
+        return "refuse", handle_https_request(request)
 
     if is_google_request(request):
-        print("Google request detected, replacing with meme...")
-        meme_path = get_random_meme()
-        print(f"Meme selected: {meme_path}")
-
-        if meme_path and os.path.exists(meme_path):
-            response = create_image_response(meme_path)
-            if response:
-                print(f"Sending meme image response instead of Google.")
-                client_socket.sendall(response)
-                client_socket.close()
-                return
-        else: 
-            print(f"Meme file not found or invalid: {meme_path}.")
+        trace("Google request detected, replacing with meme...")
+        return "google", None
 
     # Received request is either image request or not
     if is_image_request(request) and should_replace_this_image():
-        print("Detected image request, replacing with meme...")
-        meme_path = get_random_meme()
-        print(f"Meme selected: {meme_path}")
-
-        if meme_path and os.path.exists(meme_path):
-            response = create_image_response(meme_path)
-            if response:
-                print(f"Sending meme image response: {meme_path}.")
-                client_socket.sendall(response)
-                client_socket.close()
-                return
-        else: 
-            print(f"Meme file not found or invalid: {meme_path}.")
-            return
+        trace("Detected image request, replacing with meme...")
+        return "image", None
+    return "forward", None
+
+def client_wants_revalidation(request, entry):
+    """Whether the client asked for a copy checked with the origin, like a hard reload's no-cache or max-age=0"""
+    cache_control = request.header(b"cache-control")
+    if cache_control is None: # Pragma only counts when there is no Cache-Control, as HTTP/1.0 clients send
+        return b"no-cache" in (request.header(b"pragma") or b"").lower()
+    directives = cache_directives(cache_control.decode('latin-1'))
+    if "no-cache" in directives:
+        return True
+    if "max-age" in directives:
+        try:
+            max_age = int(directives["max-age"])
+        except (TypeError, ValueError):
+            return True
+        return time.time() - (entry["fresh_until"] - entry["lifetime"]) > max_age # Older than the client accepts
+    return False
+
+def meme_fallthrough(action, sent):
+    """Count a meme sent for a "google" or "image" request, returning whether the request still has to be forwarded"""
+    if sent:
+        count_stat(f"{action}_replaced")
+        trace("Sent meme image response instead of Google." if action == "google" else "Sent meme image response.")
+        return False
+    return action == "google" # Without a meme to send, Google requests go through as usual but image ones are dropped
+
+def cached_answer(request, key, entry):
+    """Response to send from the cache for request, or None if it has to go to the remote server"""
+    if entry is None or time.time() >= entry["fresh_until"] or client_wants_revalidation(request, entry):
+        return None
+    trace(f"Serving {key} from the cache.")
+    response = cached_response(entry, request.keep_alive, accepted_coding(request))
+    count_stat("cache_hits")
+    count_stat("client_bytes_out", len(response))
+    return response
 
-    print(f"Forwarding request from {client_address} to remote server...")
-    remote_socket = forward_request(request)
+def fetch_response(client_socket, client_address, request, key, entry, client_keep_alive):
+    """Get the response for a request from the remote server, revalidating a stale cache entry if there is one"""
+    if entry is not None and (entry["etag"] or entry["last_modified"]):
+        return revalidate_cached(client_socket, request, key, entry, client_keep_alive)
+
+    trace(f"Forwarding request from {client_address} to remote server...")
+    remote_socket, origin, reused = forward_request(request, client_socket=client_socket)
     if not remote_socket:
-        print("Failed to establish connection with remote server.")
-        client_socket.close()
-        return
+        trace("Failed to establish connection with remote server.")
+        return False
+    count_stat("forwarded")
 
-    # Receive response from remote server
-    print("Receiving response from remote server...")
-    response = recv_http_response(remote_socket)
-    if not response:
-        print("Received null response from remote server")
+    if not STREAM_RESPONSES:
+        # Receive response from remote server
+        trace("Receiving response from remote server...")
+        response = recv_http_response(remote_socket)
+        remote_socket.close() # The end of a buffered response is not tracked precisely enough to reuse the connection
+        if not response:
+            trace("Received null response from remote server")
+            return False
+
+        # Forward the response back to the client
+        trace("Sending response back to client...")
+        client_socket.sendall(response)
+        count_stat("upstream_bytes_in", len(response))
+        count_stat("client_bytes_out", len(response))
+        trace("Response sent to client successfully")
+        return False
+
+    return relay_response(client_socket, request, key, client_keep_alive, remote_socket, origin, reused)
+
+def relay_response(client_socket, request, key, client_keep_alive, remote_socket, origin, reused, head = b"", timings = None):
+    """Relay the remote server's response to the client while it is still arriving, caching it if allowed.
+
+    head is the start of the response if some of it was already read, timings then holds when it arrived.
+    Returns whether the client connection can carry another request."""
+    trace("Relaying response from remote server to client...")
+    method = request.method
+    capture = bytearray() if key is not None else None # Keep a copy in case the response turns out to be cacheable
+    # Compressed bodies go out chunked, which HTTP/1.0 clients do not understand
+    coding = accepted_coding(request) if request.version == b"HTTP/1.1" else None
+    timings = timings or {"sent": time.perf_counter()}
+    relayed, reusable = relay_http_response(remote_socket, client_socket, method, capture, timings, coding, head)
+    if relayed is None and reused:
+        # A pooled connection the server had already given up on, try once more on a new connection
         remote_socket.close()
-        client_socket.close()
-        return
+        remote_socket, origin, reused = forward_request(request, fresh=True)
+        if not remote_socket:
+            trace("Failed to establish connection with remote server.")
+            return False
+        timings = {"sent": time.perf_counter()}
+        relayed, reusable = relay_http_response(remote_socket, client_socket, method, capture, timings, coding)
 
-    # Forward the response back to the client
-    print("Sending response back to client...")
-    client_socket.sendall(response)
-    print("Response sent to client successfully")
-    
-    # Clean up sockets
-    remote_socket.close()
-    client_socket.close()
-    print(f"Connection closed with {client_address}.\n")
+    if relayed is None:
+        trace("Received null response from remote server")
+        count_stat("upstream_errors")
+        remote_socket.close()
+        return False
+    if "first_byte" in timings: # Missing if the connection failed before the origin sent anything
+        record_latency("upstream_first_byte", timings["first_byte"] - timings["sent"])
+        record_latency("relay", time.perf_counter() - timings["first_byte"])
+    count_stat("upstream_bytes_in", relayed)
+    count_stat("client_bytes_out", relayed - timings.get("bytes_saved", 0))
+    trace("Response relayed to client successfully")
+    if capture:
+        store_response(key, capture)
+
+    if POOL_CONNECTIONS and reusable:
+        checkin_connection(*origin, remote_socket)
+    else:
+        remote_socket.close()
+
+    # A close-delimited response can only be ended for the client by closing its connection
+    return reusable and client_keep_alive
+
+def revalidate_cached(client_socket, request, key, entry, client_keep_alive):
+    """Ask the origin whether a stale cached response is still good, serving it on 304 or relaying the new one"""
+    trace(f"Revalidating cached copy of {key}...")
+    remote_socket, origin, reused = forward_request(request, conditions=cache_conditions(entry))
+    if not remote_socket:
+        trace("Failed to establish connection with remote server.")
+        return False
+
+    timings = {"sent": time.perf_counter()}
+    head = read_response_head(remote_socket, timings)
+    if not head and reused:
+        # A pooled connection the server had already given up on, try once more on a new connection
+        remote_socket.close()
+        remote_socket, origin, reused = forward_request(request, fresh=True, conditions=cache_conditions(entry))
+        if not remote_socket:
+            trace("Failed to establish connection with remote server.")
+            return False
+        timings = {"sent": time.perf_counter()}
+        head = read_response_head(remote_socket, timings)
+    if not head:
+        trace("Received null response from remote server")
+        count_stat("upstream_errors")
+        remote_socket.close()
+        return False
+
+    header_end = head.find(b"\r\n\r\n")
+    if header_end != -1 and head.split(b"\r\n", 1)[0].split(b" ")[1:2] == [b"304"]:
+        count_stat("upstream_bytes_in", len(head))
+        # A 304 has no body, so the connection can be pooled if nothing followed its head
+        if POOL_CONNECTIONS and header_end + 4 == len(head) and is_keep_alive(head[:header_end], head.split(b" ", 1)[0]):
+            checkin_connection(*origin, remote_socket)
+        else:
+            remote_socket.close()
+
+        # Still valid: extend its freshness using the 304's headers if it sent new ones
+        lifetime = freshness_lifetime(header_fields(head[:header_end]))
+        lifetime = entry["lifetime"] if lifetime is None else lifetime
+        entry = dict(entry, fresh_until=time.time() + lifetime, lifetime=lifetime) # Its age counts from now
+        cache_put(key, entry)
+        if CACHE_DIR:
+            write_disk_entry(key, entry)
+        trace(f"Cached copy of {key} is still valid.")
+        response = cached_response(entry, client_keep_alive, accepted_coding(request))
+        client_socket.sendall(response)
+        count_stat("revalidated")
+        count_stat("client_bytes_out", len(response))
+        return client_keep_alive
+
+    # Anything else replaces our copy, it is relayed and stored like a response fetched without a cached entry
+    count_stat("forwarded")
+    return relay_response(client_socket, request, key, client_keep_alive, remote_socket, origin, reused, head, timings)
+
+def read_response_head(remote_socket, timings):
+    """Read the start of a response up to the end of its head (possibly a little past it).
+
+    Returns fewer bytes if the connection ends first, and b"" if it ends or fails before anything arrives.
+    The perf_counter time of the first byte goes in timings as "first_byte"."""
+    head = bytearray()
+    try:
+        while head.find(b"\r\n\r\n", max(0, len(head) - CHUNK_SIZE - 3)) == -1 and len(head) <= REQUEST_HEADER_LIMIT:
+            chunk = remote_socket.recv(CHUNK_SIZE)
+            if not chunk:
+                break
+            if not head:
+                timings["first_byte"] = time.perf_counter()
+            head += chunk
+    except socket.error as e:
+        trace(f"Error reading response head: {e}") # Anything that did arrive is still relayed
+    return bytes(head)
 
 def start_proxy():
-    global activeThreads
+    if WORKER_PROCESSES and not (hasattr(os, "fork") and hasattr(socket, "SO_REUSEPORT")):
+        print("Pre-fork mode needs fork and SO_REUSEPORT, serving from a single process instead.")
+    elif WORKER_PROCESSES:
+        return start_prefork(WORKER_PROCESSES)
+
+    try:
+        p_socket = open_listener()
+    except OSError as e:
+        describe_listen_error(e)
+        return
+    print(f"Proxy listening on {HOST}:{PORT} ({PROXY_MODE} mode)")
 
+    if PRELOAD_MEMES:
+        load_meme_store()
+        threading.Thread(target=watch_meme_store, daemon=True).start()
+    if METRICS_PORT:
+        start_metrics()
+    run_engine(p_socket)
+
+def open_listener(reuse_port = False):
+    """Bound and listening proxy socket, with SO_REUSEPORT for pre-fork workers that share the port"""
     p_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     p_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    p_socket.bind((HOST, PORT))
-    p_socket.listen(5) # 5 connections can be held in queue
-    print(f"Proxy listening on {HOST}:{PORT}")
-
+    if reuse_port:
+        p_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1) # The kernel spreads new connections over the workers
     try:
-        while True:
-            client_socket, addr = p_socket.accept()
-            print(f"Connection accepted from {addr}.")
-            thread = threading.Thread(target=handle_client, args=(client_socket, addr))
-            activeThreads.append(thread)
-            thread.start()
-    except socket.gaierror as e:
+        p_socket.bind((HOST, PORT))
+        # The asyncio engine takes bursts of thousands so it asks for the OS maximum
+        p_socket.listen(ASYNC_LISTEN_BACKLOG if PROXY_MODE == "asyncio" else LISTEN_BACKLOG)
+    except OSError:
+        p_socket.close()
+        raise
+    return p_socket
+
+def describe_listen_error(e):
+    """Print why the proxy could not listen or keep listening"""
+    if isinstance(e, socket.gaierror):
         print(f"Address resolution error: {e.strerror}")
-    except ConnectionRefusedError:
+    elif isinstance(e, ConnectionRefusedError):
         print(f"Connection refused on {HOST}:{PORT}")
-    except OSError as e:
-        if e.errno == errno.EADDRINUSE:
-            print(f"OS Error: Port {PORT} is already in use.")
-        elif e.errno == errno.EADDRNOTAVAIL:
-            print(f"OS Error: IP address {HOST} is not available on this machine.")
-        elif e.errno == errno.EACCES:
-            print(f"OS Error: Permission denied for port {PORT}.")
+    elif e.errno == errno.EADDRINUSE:
+        print(f"OS Error: Port {PORT} is already in use.")
+    elif e.errno == errno.EADDRNOTAVAIL:
+        print(f"OS Error: IP address {HOST} is not available on this machine.")
+    elif e.errno == errno.EACCES:
+        print(f"OS Error: Permission denied for port {PORT}.")
+    else:
+        print(f"Unexpected OS error: {e.strerror}")
+
+def run_engine(p_socket):
+    """Serve clients from p_socket with the configured engine until interrupted, then drain"""
+    try:
+        if PROXY_MODE == "asyncio":
+            asyncio.run(serve_asyncio(p_socket))
         else:
-            print(f"Unexpected OS error: {e.strerror}")
+            serve_threaded(p_socket)
+    except OSError as e:
+        describe_listen_error(e)
     except KeyboardInterrupt:
         print("\nTerminating the server connection...")
+        p_socket.close() # Stop taking new connections while the current ones finish
         end_proxy()
     finally:
-        p_socket.shutdown(socket.SHUT_RDWR)
         p_socket.close()
 
+def start_prefork(count):
+    """Master process: start count workers, restart any that crash, answer metrics for all of them and drain on exit"""
+    print(f"Proxy listening on {HOST}:{PORT} ({PROXY_MODE} mode, {count} worker processes)")
+    if PRELOAD_MEMES:
+        load_meme_store() # Loaded once here, the workers share the mapped pages
+
+    # The master stays single-threaded so forking a replacement worker is always safe
+    selector = selectors.DefaultSelector()
+    m_socket = open_metrics() if METRICS_PORT else None
+    if m_socket is not None:
+        selector.register(m_socket, selectors.EVENT_READ)
+    signal.signal(signal.SIGTERM, stop_process)
+
+    try:
+        for index in range(count):
+            spawn_worker(index, selector)
+        while workers:
+            for key, _ in selector.select(timeout=0.5):
+                if key.data is None:
+                    answer_metrics(m_socket.accept()[0])
+                else:
+                    read_worker_stats(key.data, selector)
+            if not reap_workers(selector, restart=True):
+                break
+    except KeyboardInterrupt:
+        pass
+    print("\nTerminating the worker processes...")
+    drain_workers(selector)
+    if m_socket is not None:
+        m_socket.close()
+    print(f"Shutdown process for {HOST}:{PORT} has been successfully completed.")
+
+def stop_process(signum, frame):
+    """SIGTERM handler that unwinds the main thread the same way Ctrl+C does"""
+    raise KeyboardInterrupt
+
+def spawn_worker(index, selector):
+    """Fork one worker process, with a pipe it reports its stats back through"""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        for key in list(selector.get_map().values()): # The metrics socket and the other workers' pipes are the master's
+            os.close(key.fd)
+        selector.close()
+        code = 1
+        try:
+            code = run_worker(write_fd)
+        except KeyboardInterrupt:
+            code = 0 # Told to stop before it started serving
+        except BaseException as e:
+            print(f"Worker {index} failed: {e!r}")
+        finally:
+            os._exit(code) # Leave without running the master's cleanup
+
+    os.close(write_fd)
+    os.set_blocking(read_fd, False)
+    workers[pid] = {"index": index, "started": time.monotonic(), "fd": read_fd, "pending": b"", "latest": {}}
+    selector.register(read_fd, selectors.EVENT_READ, pid)
+
+def run_worker(stats_fd):
+    """Body of a worker process: serve PORT through its own SO_REUSEPORT socket until the master says to drain"""
+    workers.clear() # That table belongs to the master
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl+C reaches the whole process group, the master decides when we stop
+    signal.signal(signal.SIGTERM, stop_process)
+    signal.signal(signal.SIGUSR1, lambda signum, frame: set_verbose(True))
+    signal.signal(signal.SIGUSR2, lambda signum, frame: set_verbose(False))
+
+    try:
+        p_socket = open_listener(reuse_port=True)
+    except OSError as e:
+        describe_listen_error(e)
+        return WORKER_BIND_FAILED
+
+    threading.Thread(target=report_worker_stats, args=(stats_fd,), daemon=True).start()
+    if PRELOAD_MEMES:
+        threading.Thread(target=watch_meme_store, daemon=True).start()
+    run_engine(p_socket)
+    return 0
+
+def report_worker_stats(stats_fd):
+    """Worker thread sending the master a JSON line with this process's stats every WORKER_STATS_INTERVAL seconds"""
+    try:
+        with os.fdopen(stats_fd, "wb") as pipe:
+            while True:
+                pipe.write(json.dumps(stats_snapshot()).encode() + b"\n")
+                pipe.flush()
+                time.sleep(WORKER_STATS_INTERVAL)
+    except OSError:
+        pass # The master went away
+
+def read_worker_stats(pid, selector):
+    """Take in whatever a worker has reported, keeping its most recent complete snapshot"""
+    worker = workers.get(pid)
+    if worker is None:
+        return
+    try:
+        data = os.read(worker["fd"], 65536)
+    except BlockingIOError:
+        return
+    if not data:
+        selector.unregister(worker["fd"]) # Worker is exiting, reap_workers cleans up the rest
+        return
+    lines = (worker["pending"] + data).split(b"\n")
+    worker["pending"] = lines.pop()
+    for line in reversed(lines):
+        try:
+            worker["latest"] = json.loads(line)
+            break
+        except ValueError:
+            continue
+
+def reap_workers(selector, restart):
+    """Collect exited workers, folding their stats into retired_stats and restarting them if asked.
+
+    Returns False if a worker could not listen on PORT, since its replacements would fail the same way."""
+    global retired_stats
+
+    while workers:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid == 0:
+            break
+        worker = workers.pop(pid, None)
+        if worker is None:
+            continue
+        if worker["fd"] in selector.get_map():
+            selector.unregister(worker["fd"])
+        os.close(worker["fd"])
+
+        # Gauges like open tunnels ended with the process, its counters and timings still count towards the totals
+        latest = dict(worker["latest"], tunnels_open=0, pool_idle=0, cache={}, dns={}, admission={})
+        restarts = retired_stats.get("restarts", 0) + (1 if restart else 0)
+        retired_stats = dict(merge_snapshots([retired_stats, latest]), restarts=restarts)
+
+        code = os.waitstatus_to_exitcode(status)
+        if code == WORKER_BIND_FAILED:
+            print(f"Worker {worker['index']} could not listen on {HOST}:{PORT}, stopping.")
+            return False
+        if restart:
+            print(f"Worker {worker['index']} (pid {pid}) exited with status {code}, starting a new one.")
+            if time.monotonic() - worker["started"] < 1:
+                time.sleep(1) # Do not spin if workers die straight away
+            spawn_worker(worker["index"], selector)
+    return True
+
+def drain_workers(selector):
+    """Ask every worker to finish its connections and exit, killing any still running after SHUTDOWN_DRAIN_TIMEOUT"""
+    for pid in list(workers):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    deadline = time.monotonic() + SHUTDOWN_DRAIN_TIMEOUT + 5 # A little longer than the workers give their own clients
+    while workers and time.monotonic() < deadline:
+        reap_workers(selector, restart=False)
+        time.sleep(0.1)
+    for pid in list(workers):
+        print(f"Worker pid {pid} did not stop in time, killing it.")
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        workers.pop(pid)
+
+def serve_threaded(p_socket):
+    """Accept loop starting a thread per client connection, at most MAX_CONNECTIONS of them serving at once"""
+    global activeThreads
+
+    slots = threading.BoundedSemaphore(MAX_CONNECTIONS)
+    while True:
+        client_socket, addr = p_socket.accept()
+        has_slot = slots.acquire(blocking=False)
+        verdict = admit_connection(addr[0], has_slot)
+        if verdict not in ("serve", "queue"):
+            if has_slot:
+                slots.release()
+            trace(f"Refusing connection from {addr}: {verdict.decode()}")
+            shed_connection(client_socket, verdict)
+            continue
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # Relayed pieces go out now, not after a delayed ACK
+        trace(f"Connection accepted from {addr}.")
+        activeThreads = [thread for thread in activeThreads if thread.is_alive()] # Forget clients that already left
+        thread = threading.Thread(target=handle_admitted, args=(client_socket, addr, slots, verdict == "queue"))
+        activeThreads.append(thread)
+        thread.start()
+
+async def serve_asyncio(p_socket):
+    """Accept loop serving every client from one event loop, at most ASYNC_MAX_CONNECTIONS of them at once"""
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=ASYNC_UPSTREAM_WORKERS))
+    # A client and a remote socket per connection, plus the queued clients and some spare
+    raise_file_limit(ASYNC_MAX_CONNECTIONS * 2 + ADMISSION_QUEUE_LIMIT + 64)
+    p_socket.setblocking(False)
+
+    slots = asyncio.Semaphore(ASYNC_MAX_CONNECTIONS)
+    tasks = set() # Strong references, the event loop only keeps weak ones to running tasks
+    stop = asyncio.Event()
+    try:
+        loop.add_signal_handler(signal.SIGTERM, stop.set) # SIGTERM drains, Ctrl+C still stops straight away
+    except (NotImplementedError, RuntimeError): # Windows event loops, or not the main thread
+        pass
+
+    accepting = asyncio.create_task(accept_async(loop, p_socket, slots, tasks))
+    stopping = asyncio.create_task(stop.wait())
+    await asyncio.wait({accepting, stopping}, return_when=asyncio.FIRST_COMPLETED)
+    if accepting.done():
+        stopping.cancel()
+        return accepting.result() # Raises whatever ended the accept loop
+
+    print("\nDraining client connections...")
+    accepting.cancel()
+    p_socket.close()
+    close_waiting_clients()
+    if tasks:
+        await asyncio.wait(tasks, timeout=SHUTDOWN_DRAIN_TIMEOUT)
+
+async def accept_async(loop, p_socket, slots, tasks):
+    """Accept clients and start a task for each, queueing or refusing them once every slot is taken"""
+    while True:
+        try:
+            client_socket, addr = await loop.sock_accept(p_socket)
+        except OSError as e:
+            if e.errno not in (errno.EMFILE, errno.ENFILE):
+                raise
+            print(f"Out of file descriptors, pausing accepts: {e.strerror}")
+            await asyncio.sleep(0.1)
+            continue
+        has_slot = not slots.locked()
+        if has_slot:
+            await slots.acquire() # Free, so this returns straight away
+        verdict = admit_connection(addr[0], has_slot)
+        if verdict not in ("serve", "queue"):
+            if has_slot:
+                slots.release()
+            trace(f"Refusing connection from {addr}: {verdict.decode()}")
+            shed_connection(client_socket, verdict)
+            continue
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        trace(f"Connection accepted from {addr}.")
+        task = asyncio.create_task(handle_client_async(loop, client_socket, addr, slots, verdict == "queue"))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+def raise_file_limit(wanted):
+    """Raise the open file limit towards wanted where the OS lets us, so the connection cap is what actually binds"""
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY or soft >= wanted:
+        return
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted if hard == resource.RLIM_INFINITY else min(wanted, hard), hard))
+    except (ValueError, OSError) as e:
+        print(f"Could not raise the open file limit: {e}")
+
+async def handle_client_async(loop, client_socket, client_address, slots, queued = False):
+    """Asyncio counterpart of handle_admitted and handle_client, serving requests until the client is done"""
+    client_socket.setblocking(False)
+    if queued:
+        try:
+            await asyncio.wait_for(slots.acquire(), ADMISSION_QUEUE_TIMEOUT)
+            leave_queue(True)
+        except asyncio.TimeoutError:
+            leave_queue(False)
+            finish_connection(client_address[0], False)
+            trace(f"No slot freed up for {client_address}, refusing it.")
+            shed_connection(client_socket, b"503 Service Unavailable")
+            return
+
+    try:
+        connection = {"pending": b""} # Bytes of pipelined requests read along with the one before them
+        while await serve_request_async(loop, client_socket, client_address, connection):
+            pass
+    except asyncio.TimeoutError:
+        trace(f"Connection with {client_address} was idle for too long.")
+    except socket.error as e:
+        trace(f"Socket error encountered while serving {client_address}: {e}.")
+    finally:
+        client_socket.close()
+        slots.release()
+        finish_connection(client_address[0], True)
+        trace(f"Connection closed with {client_address}.\n")
+
+async def serve_request_async(loop, client_socket, client_address, connection = None):
+    """Asyncio counterpart of serve_request.
+
+    Reading the request, memes and memory cache hits are handled on the event loop. The disk cache tier and anything
+    that has to talk to a remote server run the blocking helpers on a worker thread, so the loop never waits on them."""
+    trace("Receiving client request...")
+    request = await asyncio.wait_for(recv_http_request_async(loop, client_socket, connection), CLIENT_IDLE_TIMEOUT)
+    if not request:
+        trace("Received null request from client.")
+        return False
+    request = parse_client_request(request)
+    if request is None:
+        trace("Received malformed request from client.")
+        return False
+
+    action, response = classify_request(request, client_address)
+    if action == "refuse":
+        await loop.sock_sendall(client_socket, response)
+        return False
+    if action == "tunnel":
+        await run_blocking(loop, client_socket, open_tunnel, client_socket, request)
+        return False
+    if action in ("google", "image"):
+        if not meme_fallthrough(action, await send_replacement_meme_async(loop, client_socket, accepted_coding(request))):
+            return False
+
+    key = cache_key(request) if CACHE_RESPONSES else None
+    entry = cache_get(key, disk=False) if key is not None else None
+    if entry is None and key is not None and CACHE_DIR:
+        # Reading the disk tier and compressing what it promotes would stall every client on the loop
+        entry = await loop.run_in_executor(None, cache_get, key)
+    response = cached_answer(request, key, entry)
+    if response is not None:
+        await loop.sock_sendall(client_socket, response)
+        return request.keep_alive
+
+    return await run_blocking(loop, client_socket, fetch_response,
+                              client_socket, client_address, request, key, entry, request.keep_alive)
+
+async def recv_http_request_async(loop, sock, connection = None):
+    """Asyncio counterpart of recv_http_request, driving the same reader without holding a thread"""
+    pending = connection["pending"] if connection else b""
+    state = new_request_state(pending)
+    waiting = connection is not None and not pending
+    if waiting and not start_waiting(sock):
+        return b""
+    more = request_received(state, len(pending)) if pending else True
+    if waiting:
+        try:
+            more = request_received(state, await loop.sock_recv_into(sock, request_space(state)))
+        finally:
+            stop_waiting(sock)
+    while more:
+        if state["expect_continue"]:
+            state["expect_continue"] = False
+            await loop.sock_sendall(sock, b"HTTP/1.1 100 Continue\r\n\r\n")
+        more = request_received(state, await loop.sock_recv_into(sock, request_space(state)))
+    if connection is not None:
+        connection["pending"] = request_leftover(state)
+    if state["error"]:
+        trace(f"Refusing request: {state['error'].decode()}")
+        count_stat("bad_requests")
+        await loop.sock_sendall(sock, status_response(state["error"]))
+    return request_bytes(state)
+
+async def run_blocking(loop, client_socket, function, *args):
+    """Run one of the blocking helpers on a worker thread, with the client socket in blocking mode while it does"""
+    client_socket.settimeout(CLIENT_IDLE_TIMEOUT)
+    try:
+        return await loop.run_in_executor(None, function, *args)
+    finally:
+        if client_socket.fileno() != -1: # open_tunnel detaches the socket once the tunnel pump owns it
+            client_socket.setblocking(False)
+
+async def send_replacement_meme_async(loop, client_socket, coding = None):
+    """Asyncio counterpart of send_replacement_meme, using the event loop's sendfile for preloaded memes"""
+    if not PRELOAD_MEMES:
+        return await run_blocking(loop, client_socket, send_replacement_meme, client_socket, coding)
+
+    memes = meme_store
+    if not memes:
+        trace("No memes are loaded.")
+        return False
+    meme = random.choice(memes)
+    trace(f"Meme selected: {meme['path']}")
+    if coding in meme["encoded"]:
+        await loop.sock_sendall(client_socket, meme["encoded"][coding])
+        count_stat("client_bytes_out", len(meme["encoded"][coding]))
+        return True
+    await loop.sock_sendall(client_socket, meme["header"])
+    count_stat("client_bytes_out", len(meme["header"]) + meme["size"])
+    if meme["size"]:
+        await loop.sock_sendfile(client_socket, meme["file"], 0, meme["size"])
+    return True
+
 def end_proxy():
     print(f"Beginning shutdown process for {HOST}:{PORT}...")
+    close_waiting_clients()
 
+    deadline = time.monotonic() + SHUTDOWN_DRAIN_TIMEOUT
     for thread in activeThreads:
-        thread.join() # Join back to main process
+        if thread.is_alive():
+            thread.join(max(0, deadline - time.monotonic())) # Join back to main process
 
     print(f"Shutdown process for {HOST}:{PORT} has been successfully completed.")
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1: # Optionally pick the serving mode from the command line, e.g. `python proxy.py asyncio`
+        PROXY_MODE = sys.argv[1]
+    if len(sys.argv) > 2: # and a number of pre-fork worker processes, e.g. `python proxy.py asyncio 4`
+        WORKER_PROCESSES = int(sys.argv[2])
     start_proxy()
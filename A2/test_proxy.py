@@ -0,0 +1,282 @@
+import http.server
+import socket
+import threading
+import time
+import unittest
+from unittest import mock
+
+import proxy
+from proxy import (decode_chunked, new_chunked_state, new_request_state, parse_body_headers, relay_http_response,
+                   request_bytes, request_leftover, request_received, request_space, scan_chunked)
+
+CHUNKED_BODY = b"5;name=value\r\nhello\r\n1a\r\n" + b"x" * 26 + b"\r\n0\r\nX-Trailer: yes\r\nX-Other: no\r\n\r\n"
+BAD_CHUNK_SIZES = [b"zz", b"-5", b"+5", b"0x5", b"1_0", b""]
+
+class ScanChunkedTest(unittest.TestCase):
+    """scan_chunked must find the end of a chunked body however the reads split it"""
+
+    def scan(self, pieces):
+        state, offset = new_chunked_state(), 0
+        for piece in pieces:
+            end = scan_chunked(state, piece)
+            if end != -1:
+                return offset + end
+            offset += len(piece)
+        return -1
+
+    def test_every_split(self):
+        data = CHUNKED_BODY + b"GET /next"
+        for i in range(len(data) + 1):
+            for j in range(i, len(data) + 1):
+                self.assertEqual(self.scan([data[:i], data[i:j], data[j:]]), len(CHUNKED_BODY), (i, j))
+
+    def test_growing_buffer(self):
+        # The request reader passes the whole buffer so far and where the new bytes start
+        state, end = new_chunked_state(), -1
+        for received in range(1, len(CHUNKED_BODY) + 1):
+            end = scan_chunked(state, memoryview(CHUNKED_BODY)[:received], received - 1)
+            if end != -1:
+                break
+        self.assertEqual((end, received), (len(CHUNKED_BODY), len(CHUNKED_BODY)))
+
+    def test_incomplete(self):
+        self.assertEqual(self.scan([CHUNKED_BODY[:-1]]), -1)
+
+    def test_malformed_size(self):
+        for size in BAD_CHUNK_SIZES:
+            with self.assertRaises(ValueError, msg=size):
+                self.scan([b"5\r\nhello\r\n" + size + b"\r\nabc\r\n0\r\n\r\n"])
+
+    def test_line_too_long(self):
+        with self.assertRaises(ValueError):
+            self.scan([b"1" * 5000, b"1" * 5000])
+
+    def test_decode(self):
+        self.assertEqual(decode_chunked(CHUNKED_BODY), b"hello" + b"x" * 26)
+        with self.assertRaises(ValueError):
+            decode_chunked(b"zz\r\nabc\r\n0\r\n\r\n")
+
+class ParseBodyHeadersTest(unittest.TestCase):
+    def test_framing(self):
+        self.assertEqual(parse_body_headers(b"HTTP/1.1 200 OK\r\nContent-Length: 12\r\n\r\n"), (12, False))
+        self.assertEqual(parse_body_headers(b"HTTP/1.1 200 OK\r\ntransfer-encoding: gzip, chunked\r\n\r\n"), (None, True))
+        self.assertEqual(parse_body_headers(b"HTTP/1.1 200 OK\r\nContent-Length: 3\r\nContent-Length: 3\r\n\r\n"), (3, False))
+
+    def test_other_headers_ignored(self):
+        head = b"HTTP/1.1 200 OK\r\nX-Content-Length: 5\r\nX-Transfer-Encoding: chunked\r\n\r\n"
+        self.assertEqual(parse_body_headers(head), (None, False))
+
+    def test_bad_content_length(self):
+        for value in [b"-5", b"+5", b"5 5", b"abc", b"", b"3\r\nContent-Length: 4"]:
+            with self.assertRaises(ValueError, msg=value):
+                parse_body_headers(b"HTTP/1.1 200 OK\r\nContent-Length: " + value + b"\r\n\r\n")
+
+class RequestReaderTest(unittest.TestCase):
+    """The client request reader, fed the way recv_http_request feeds it"""
+
+    def read(self, pieces, pending = b""):
+        state = new_request_state(pending)
+        more = request_received(state, len(pending)) if pending else True
+        for piece in pieces:
+            if not more:
+                break
+            space = request_space(state)
+            space[:len(piece)] = piece
+            more = request_received(state, len(piece))
+        return state
+
+    def test_chunked_split(self):
+        head = b"POST http://origin/ HTTP/1.1\r\nHost: origin\r\nTransfer-Encoding: chunked\r\n\r\n"
+        data = head + CHUNKED_BODY
+        for i in range(len(head) - 2, len(data)):
+            state = self.read([data[:i], data[i:]])
+            self.assertEqual(request_bytes(state), data, i)
+
+    def test_malformed_chunk_size(self):
+        for size in BAD_CHUNK_SIZES:
+            state = self.read([b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n" + size + b"\r\nabc\r\n"])
+            self.assertEqual(state["error"], b"400 Bad Request", size)
+
+    def test_bad_content_length(self):
+        state = self.read([b"POST / HTTP/1.1\r\nContent-Length: -5\r\n\r\n"])
+        self.assertEqual(state["error"], b"400 Bad Request")
+
+    def test_pipelined(self):
+        first = b"GET http://origin/a HTTP/1.1\r\nHost: origin\r\n\r\n"
+        second = b"POST http://origin/b HTTP/1.1\r\nHost: origin\r\nContent-Length: 3\r\n\r\nabc"
+        state = self.read([first + second[:10]])
+        self.assertEqual((request_bytes(state), request_leftover(state)), (first, second[:10]))
+        state = self.read([second[10:]], request_leftover(state))
+        self.assertEqual((request_bytes(state), request_leftover(state)), (second, b""))
+
+class RawOrigin(http.server.BaseHTTPRequestHandler):
+    """Origin that sends the raw pieces registered for a path, pausing between them so each arrives in its own read"""
+    protocol_version = "HTTP/1.1"
+    responses = {}
+
+    def do_GET(self):
+        for piece in self.responses[self.path]:
+            self.wfile.write(piece)
+            time.sleep(0.02)
+
+    def log_message(self, *args):
+        pass
+
+class RelayHttpResponseTest(unittest.TestCase):
+    """relay_http_response against an http.server origin, over a socket pair standing in for the client"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.origin = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RawOrigin)
+        cls.origin.daemon_threads = True
+        threading.Thread(target=cls.origin.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.origin.shutdown()
+        cls.origin.server_close()
+
+    def connect(self):
+        return socket.create_connection(self.origin.server_address, timeout=5)
+
+    def relay(self, path, pieces, remote = None):
+        """Relay the response to GET path, returning (bytes relayed, reusable, what the client got, captured copy).
+
+        The request goes over remote, or over a connection of its own that is closed afterwards if that is None."""
+        if remote is None:
+            with self.connect() as remote:
+                return self.relay(path, pieces, remote)
+        RawOrigin.responses[path] = pieces
+        remote.sendall(b"GET " + path.encode() + b" HTTP/1.1\r\nHost: origin\r\n\r\n")
+        client, peer = socket.socketpair()
+        with client, peer:
+            capture = bytearray()
+            relayed, reusable = relay_http_response(remote, client, capture=capture)
+            client.shutdown(socket.SHUT_WR)
+            received = b""
+            while chunk := peer.recv(65536):
+                received += chunk
+        return relayed, reusable, received, bytes(capture)
+
+    def test_chunked_split_with_trailers(self):
+        head = b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+        response = head + CHUNKED_BODY
+        # Split inside the blank line after the head, a size line, a chunk's CRLF and the trailers
+        cuts = [len(head) - 2, len(head) + 3, len(head) + 18, len(response) - 20, len(response) - 1]
+        pieces = [response[i:j] for i, j in zip([0] + cuts, cuts + [len(response)])]
+        again = b"HTTP/1.1 200 OK\r\nContent-Length: 4\r\n\r\nnext"
+        with self.connect() as remote:
+            # Chunked responses are never cached, so nothing is captured
+            self.assertEqual(self.relay("/chunked", pieces, remote), (len(response), True, response, b""))
+            # The relay stopped right at the end of the body, so the connection carries the next response intact
+            self.assertEqual(self.relay("/again", [again], remote), (len(again), True, again, again))
+
+    def test_content_length_split(self):
+        response = b"HTTP/1.1 200 OK\r\nContent-Length: 3000\r\n\r\n" + b"y" * 3000
+        pieces = [response[:10], response[10:40], response[40:1500], response[1500:]]
+        self.assertEqual(self.relay("/length", pieces), (len(response), True, response, response))
+
+    def test_malformed_chunk_size(self):
+        head = b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+        for size in [b"zz", b"-5"]:
+            with self.subTest(size=size): # Each on a connection of its own, as the relay leaves it mid-response
+                relayed, reusable, received, capture = self.relay("/bad-" + size.decode(), [head, size + b"\r\nabcde\r\n"])
+                self.assertFalse(reusable)
+                self.assertEqual(received, head)
+
+    def test_bad_content_length(self):
+        relayed, reusable, received, capture = self.relay("/bad-length", [b"HTTP/1.1 200 OK\r\nContent-Length: -5\r\n\r\n"])
+        self.assertFalse(reusable)
+        self.assertEqual(received, b"")
+
+class DnsCacheTest(unittest.TestCase):
+    """resolve and its cache, with a stub dns_resolver standing in for the network"""
+
+    def setUp(self):
+        self.calls = 0
+        self.answer = lambda host, port: ([(socket.AF_INET, socket.SOCK_STREAM, 0, ("127.0.0.1", port))], None)
+        patches = [mock.patch.object(proxy, "dns_resolver", self.stub), mock.patch.object(proxy, "DNS_CACHE", True),
+                   mock.patch.object(proxy, "dns_cache", proxy.OrderedDict()), mock.patch.object(proxy, "dns_inflight", {}),
+                   mock.patch.object(proxy, "dns_counters", dict.fromkeys(proxy.dns_counters, 0))]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def stub(self, host, port):
+        self.calls += 1
+        return self.answer(host, port)
+
+    def fail(self, host, port):
+        raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+
+    def stats(self):
+        stats = proxy.dns_cache_stats()
+        del stats["entries"]
+        return stats
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, "timed out")
+            time.sleep(0.005)
+
+    def test_hit_and_ttl_expiry(self):
+        self.answer = lambda host, port: ([(socket.AF_INET, socket.SOCK_STREAM, 0, ("127.0.0.1", port))], 0.1)
+        first = proxy.resolve("origin", 80)
+        self.assertEqual(proxy.resolve("origin", 80), first)
+        self.assertEqual(self.calls, 1)
+        time.sleep(0.15)
+        proxy.resolve("origin", 80)
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(self.stats(), {"hits": 1, "misses": 2, "negative_hits": 0, "refreshes": 0, "failures": 0})
+
+    def test_negative_caching(self):
+        self.answer = self.fail
+        with mock.patch.object(proxy, "DNS_NEGATIVE_TTL", 0.1):
+            for _ in range(3):
+                with self.assertRaises(socket.gaierror):
+                    proxy.resolve("missing", 80)
+            self.assertEqual(self.calls, 1)
+            time.sleep(0.15)
+            with self.assertRaises(socket.gaierror):
+                proxy.resolve("missing", 80)
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(self.stats(), {"hits": 0, "misses": 2, "negative_hits": 2, "refreshes": 0, "failures": 2})
+
+    def test_concurrent_lookups_share_one(self):
+        release = threading.Event()
+        answer = self.answer
+        self.answer = lambda host, port: release.wait() and answer(host, port)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(proxy.resolve("origin", 80))) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        self.wait_for(lambda: self.calls == 1)
+        time.sleep(0.05) # Let the other threads reach the in-flight lookup
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((self.calls, len(results), len(set(map(repr, results)))), (1, 10, 1))
+        self.assertEqual(self.stats()["misses"], 1)
+
+    def test_refresh_ahead(self):
+        with mock.patch.object(proxy, "DNS_REFRESH_AHEAD", 0):
+            proxy.resolve("origin", 80)
+            proxy.resolve("origin", 80) # Past refresh_at, answered from the cache and refreshed in the background
+            self.wait_for(lambda: self.calls == 2 and not proxy.dns_cache[("origin", 80)]["refreshing"])
+        self.assertEqual(self.stats(), {"hits": 1, "misses": 1, "negative_hits": 0, "refreshes": 1, "failures": 0})
+
+    def test_failed_refresh_backs_off(self):
+        with mock.patch.object(proxy, "DNS_REFRESH_AHEAD", 0):
+            addresses = proxy.resolve("origin", 80)
+            self.answer = self.fail
+            self.assertEqual(proxy.resolve("origin", 80), addresses)
+            self.wait_for(lambda: proxy.dns_counters["failures"] == 1)
+            self.wait_for(lambda: not proxy.dns_cache[("origin", 80)]["refreshing"])
+            for _ in range(200): # The old answer is still served, without asking the resolver again
+                self.assertEqual(proxy.resolve("origin", 80), addresses)
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(self.stats(), {"hits": 201, "misses": 1, "negative_hits": 0, "refreshes": 1, "failures": 1})
+
+if __name__ == "__main__":
+    unittest.main()
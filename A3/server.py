@@ -2,15 +2,28 @@ import socket
 from threading import Thread
 import random
 import logging
+import logging.handlers
+import queue
+import time
 import errno
+import signal
 import sys
 
 Clients = {}
 HOST = '127.0.0.1'
 PORT = 6969
 
+ASYNC_LOGGING = True # Hand log records to a background writer thread instead of writing them on the connection threads
+LOG_FLUSH_INTERVAL = 1.0 # Seconds the writer may hold written records before flushing them to disk
+LOG_BATCH_SIZE = 512 # Most records the writer takes off the queue per write
+
+log_queue = None # records waiting for the background log writer
+log_thread = None
+
 # Set up basic logging configuration
-logging.basicConfig(filename='server_log.txt', level=logging.INFO, format='%(asctime)s - %(message)s')
+LOG_FILE = 'server_log.txt'
+LOG_FORMAT = '%(asctime)s - %(message)s'
+logging.basicConfig(filename=LOG_FILE, level=logging.INFO, format=LOG_FORMAT)
 
 PANDA_EMOJIS = ["🐼","🎋", "⛩️", "🏯"]
 PANDA_FACTS = [
@@ -41,7 +54,11 @@ PANDA_FACTS = [
 
 def setup():
     """Start the socket, and begin listening for connections"""
+    signal.signal(signal.SIGTERM, stop_server) # Shut down the same way as Ctrl+C
     try:
+        if ASYNC_LOGGING:
+            start_async_logging()
+
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM) # initialize socket
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # set relevant sock options
 
@@ -55,6 +72,68 @@ def setup():
         print(f"Socket error: {e}")
     except Exception as e:
         print(f"Unexpected error: {e}")
+    finally:
+        stop_async_logging() # However the server stops, every queued record still reaches the log file
+
+def stop_server(signum, frame):
+    """SIGTERM handler that unwinds the accept loop the same way Ctrl+C does"""
+    raise KeyboardInterrupt
+
+def start_async_logging():
+    """Route every log record through a queue so that only the writer thread touches the log file"""
+    global log_queue, log_thread
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]: # Drop the synchronous file handler set up by basicConfig
+        root.removeHandler(handler)
+        handler.close()
+
+    log_queue = queue.SimpleQueue()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    log_thread = Thread(target = log_writer, args = (log_queue,), daemon = True)
+    log_thread.start()
+
+def log_writer(records):
+    """Drain queued records into the log file in batches, flushing at most every LOG_FLUSH_INTERVAL seconds"""
+    formatter = logging.Formatter(LOG_FORMAT)
+    with open(LOG_FILE, 'a', encoding='utf-8') as log_file:
+        last_flush = time.monotonic()
+        unflushed = False
+        while True:
+            timeout = max(0, LOG_FLUSH_INTERVAL - (time.monotonic() - last_flush)) if unflushed else None
+            try:
+                batch = [records.get(timeout=timeout)]
+            except queue.Empty: # Quiet period, push out what has been written so far
+                log_file.flush()
+                last_flush, unflushed = time.monotonic(), False
+                continue
+
+            while len(batch) < LOG_BATCH_SIZE:
+                try:
+                    batch.append(records.get_nowait())
+                except queue.Empty:
+                    break
+
+            stopping = None in batch # Sentinel queued by stop_async_logging
+            log_file.write(''.join(formatter.format(record) + '\n' for record in batch if record is not None))
+            unflushed = True
+
+            if stopping or time.monotonic() - last_flush >= LOG_FLUSH_INTERVAL:
+                log_file.flush()
+                last_flush, unflushed = time.monotonic(), False
+            if stopping:
+                return
+
+def stop_async_logging():
+    """Flush everything still queued to the log file and stop the writer thread"""
+    global log_queue, log_thread
+
+    if log_thread is None:
+        return
+
+    log_queue.put(None)
+    log_thread.join()
+    log_queue = log_thread = None
 
 def shutdown(server_socket):
     """Properly shutdown the server and all connected clients"""
@@ -75,7 +154,7 @@ def shutdown(server_socket):
 
     print("Server shut down successfully.")
     logging.info("Server socket closed successfully.")
-    sys.exit(0)  # Exit the program
+    sys.exit(0)  # Exit the program, setup's finally flushes the log on the way out
 
 def listen(server_socket):
     """Listen for new client connections on main thread if valid, handle the client in a new thread"""